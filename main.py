@@ -1,32 +1,46 @@
-from cProfile import label
-import ctypes
-from http import client
-from pickle import TRUE
-from re import search
+import time
+# Startup timings are measured from here, run with python -X importtime for a per-module breakdown
+STARTED_AT = time.perf_counter()
+
 #from turtle import position
 import discord
 import asyncio
 import functools
+import heapq
 import itertools
 import math
 import random
 import os
 import logging
+import collections
+import json
+import importlib
+import threading
 #from keep_alive import keep_alive
 #import youtube_dl
 from yt_dlp import YoutubeDL
-from async_timeout import timeout
 from discord.ext import commands
 from dotenv import load_dotenv
 from discord import Guild, User, app_commands
 from discord.utils import get
 from discord.ui import Button, View
-import ctypes
-import subprocess
+import ctypes.util
 import sys
+import shlex
+import urllib.parse
+import concurrent.futures
+import multiprocessing
+import sqlite3
+import subprocess
+import shutil
 
 load_dotenv()
 
+# Extractor processes (EXTRACT_MODE=process) import this file under this name.
+# They only need the worker jobs, the bot, its caches and its log file stay
+# in the main process, see the bottom of the file.
+EXTRACTOR_PROCESS = __name__ == '__mp_main__'
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -34,9 +48,10 @@ logging.basicConfig(
     handlers=[
         logging.FileHandler('bot.log'),
         logging.StreamHandler()
-    ]
+    ] if not EXTRACTOR_PROCESS else [logging.StreamHandler()]
 )
 logger = logging.getLogger('MusicBot')
+logger.info(f'Imports took {time.perf_counter() - STARTED_AT:.2f} seconds')
 ## Silence useless bug reports messages
 #youtube_dl.utils.bug_reports_message = lambda: ''
 
@@ -45,23 +60,235 @@ DOWNLOADS_DIR = 'downloads'
 os.makedirs(DOWNLOADS_DIR, exist_ok=True)
 logger.info(f'Downloads directory: {os.path.abspath(DOWNLOADS_DIR)}')
 
-
-def update_yt_dlp():
+# Download cache budget, defaults to 5 GB
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', 5 * 1024 ** 3))
+CACHE_INDEX_PATH = os.path.join(DOWNLOADS_DIR, 'index.json')
+
+# Search results and trimmed track metadata survive restarts in this SQLite file
+METADATA_DB_PATH = os.getenv('METADATA_DB_PATH', 'metadata.db')
+QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', 7 * 24 * 3600))
+INFO_CACHE_TTL = int(os.getenv('INFO_CACHE_TTL', 24 * 3600))
+
+# Playlists are listed PLAYLIST_CHUNK entries at a time, up to PLAYLIST_MAX_ENTRIES
+PLAYLIST_CHUNK = int(os.getenv('PLAYLIST_CHUNK', 50))
+PLAYLIST_MAX_ENTRIES = int(os.getenv('PLAYLIST_MAX_ENTRIES', 200))
+
+# 'fifo' plays songs in the order they were added, 'fair' takes turns between
+# requesters. Guilds can switch with /queuemode.
+QUEUE_MODE = os.getenv('QUEUE_MODE', 'fifo')
+if QUEUE_MODE not in ('fifo', 'fair'):
+    logger.warning(f'Unknown QUEUE_MODE {QUEUE_MODE}, using fifo')
+    QUEUE_MODE = 'fifo'
+
+# Queues and player state are journaled here and restored on startup
+STATE_DIR = os.getenv('STATE_DIR', 'state')
+os.makedirs(STATE_DIR, exist_ok=True)
+STATE_JOURNAL_PATH = os.path.join(STATE_DIR, 'journal.jsonl')
+# Seconds between journal writes, position updates and full rewrites of the journal
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', 1))
+STATE_POSITION_INTERVAL = float(os.getenv('STATE_POSITION_INTERVAL', 15))
+STATE_COMPACT_INTERVAL = float(os.getenv('STATE_COMPACT_INTERVAL', 300))
+
+# Seconds between voice health checks, how long a connection may stay down
+# before the bot reconnects itself, and the longest wait between reconnect rounds
+VOICE_CHECK_INTERVAL = float(os.getenv('VOICE_CHECK_INTERVAL', 5))
+VOICE_RECONNECT_GRACE = float(os.getenv('VOICE_RECONNECT_GRACE', 10))
+VOICE_RECONNECT_MAX_DELAY = float(os.getenv('VOICE_RECONNECT_MAX_DELAY', 300))
+
+# Guilds with an empty channel, nothing queued or a paused player for this
+# many seconds get disconnected and their voice state dropped
+IDLE_TIMEOUT = float(os.getenv('IDLE_TIMEOUT', 600))
+REAPER_INTERVAL = float(os.getenv('REAPER_INTERVAL', 60))
+# Seconds the bot stays, paused, in a channel everyone has left
+EMPTY_CHANNEL_GRACE = float(os.getenv('EMPTY_CHANNEL_GRACE', 120))
+
+# Voice joins and leaves are posted to each guild's #logs channel in batches,
+# every VOICE_LOG_INTERVAL seconds or once VOICE_LOG_BATCH lines are waiting.
+# Lines beyond VOICE_LOG_MAX_PENDING per guild are dropped.
+VOICE_LOG_INTERVAL = float(os.getenv('VOICE_LOG_INTERVAL', 10))
+VOICE_LOG_BATCH = int(os.getenv('VOICE_LOG_BATCH', 20))
+VOICE_LOG_MAX_PENDING = int(os.getenv('VOICE_LOG_MAX_PENDING', 200))
+
+# Most songs one member can have queued in a guild, 0 for no limit
+MAX_SONGS_PER_USER = int(os.getenv('MAX_SONGS_PER_USER', 0))
+
+# yt-dlp runs on its own pool of workers: 'thread' or 'process'
+EXTRACT_MODE = os.getenv('EXTRACT_MODE', 'thread')
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', 4))
+# Jobs allowed to wait for a worker, in total and per guild
+EXTRACT_QUEUE_DEPTH = int(os.getenv('EXTRACT_QUEUE_DEPTH', 100))
+EXTRACT_GUILD_DEPTH = int(os.getenv('EXTRACT_GUILD_DEPTH', 25))
+# Seconds before a lookup or a download is given up on, waiting for a worker included
+EXTRACT_TIMEOUT = float(os.getenv('EXTRACT_TIMEOUT', 60))
+DOWNLOAD_TIMEOUT = float(os.getenv('DOWNLOAD_TIMEOUT', 600))
+# JSON merged over YTDLSource.YTDL_OPTIONS, read again whenever the extractor is reloaded
+YTDL_OPTIONS_PATH = os.getenv('YTDL_OPTIONS_PATH', 'ytdl_options.json')
+# YouTube player clients are tried one at a time, best recent record first.
+# A client that succeeded less than CLIENT_SKIP_RATE of its last
+# CLIENT_MIN_SAMPLES (or more) tries within CLIENT_WINDOW seconds is skipped
+# for CLIENT_SKIP_SECONDS.
+CLIENT_WINDOW = float(os.getenv('CLIENT_WINDOW', 300))
+CLIENT_MIN_SAMPLES = int(os.getenv('CLIENT_MIN_SAMPLES', 5))
+CLIENT_SKIP_RATE = float(os.getenv('CLIENT_SKIP_RATE', 0.5))
+CLIENT_SKIP_SECONDS = float(os.getenv('CLIENT_SKIP_SECONDS', 120))
+# Downloads allowed at once across all guilds, and the bandwidth they share
+# in bytes per second (0 for no limit). Each download fetches up to
+# DOWNLOAD_FRAGMENTS fragments in parallel, in chunks of DOWNLOAD_CHUNK_SIZE bytes.
+DOWNLOAD_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', 3))
+DOWNLOAD_BANDWIDTH = float(os.getenv('DOWNLOAD_BANDWIDTH', 0))
+DOWNLOAD_FRAGMENTS = int(os.getenv('DOWNLOAD_FRAGMENTS', 4))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', 10 * 1024 * 1024))
+# Share of lookups whose full info dict gets measured for /trackmemory, 0 to never
+TRACK_MEMORY_SAMPLE = float(os.getenv('TRACK_MEMORY_SAMPLE', 0))
+
+# How many queued songs (behind the current one) get their audio downloaded ahead of time
+FETCH_AHEAD = int(os.getenv('FETCH_AHEAD', 2))
+# Gaps between tracks longer than this (seconds) get logged as warnings
+TRACK_GAP_TARGET = 0.2
+
+# 'download' saves songs to DOWNLOADS_DIR before playing, 'stream' pipes the
+# stream URL straight into FFmpeg, 'progressive' downloads without converting
+# and starts playing once PROGRESSIVE_BUFFER bytes are on disk.
+# Guilds can override this with /mode.
+PLAYBACK_MODES = ('download', 'stream', 'progressive')
+PLAYBACK_MODE = os.getenv('PLAYBACK_MODE', 'download')
+PROGRESSIVE_BUFFER = int(os.getenv('PROGRESSIVE_BUFFER', 256 * 1024))
+
+# Send Opus sources (most YouTube audio) to discord without re-encoding. Downloads
+# are then kept as Opus instead of being converted to mp3.
+OPUS_PASSTHROUGH = os.getenv('OPUS_PASSTHROUGH', 'true').lower() in ('1', 'true', 'yes')
+if PLAYBACK_MODE not in PLAYBACK_MODES:
+    logger.warning(f'Unknown PLAYBACK_MODE {PLAYBACK_MODE}, using download')
+    PLAYBACK_MODE = 'download'
+
+# 'minimal' only receives guild, voice state and message events and caches
+# just the members in voice channels. 'full' receives everything and caches
+# every member of every guild at startup.
+INTENTS_PROFILES = ('minimal', 'full')
+INTENTS_PROFILE = os.getenv('INTENTS_PROFILE', 'minimal')
+if INTENTS_PROFILE not in INTENTS_PROFILES:
+    logger.warning(f'Unknown INTENTS_PROFILE {INTENTS_PROFILE}, using minimal')
+    INTENTS_PROFILE = 'minimal'
+
+
+# 'background' updates yt-dlp after connecting, 'blocking' before connecting
+# (the old behaviour), 'off' never. With YTDLP_WHEEL_DIR set, the update is
+# installed from wheels in that directory instead of the package index.
+# Each update goes into its own directory under YTDLP_DIR, the installed
+# package is never touched while the bot uses it.
+YTDLP_UPDATE_MODES = ('background', 'blocking', 'off')
+YTDLP_UPDATE = os.getenv('YTDLP_UPDATE', 'background')
+if YTDLP_UPDATE not in YTDLP_UPDATE_MODES:
+    logger.warning(f'Unknown YTDLP_UPDATE {YTDLP_UPDATE}, using background')
+    YTDLP_UPDATE = 'background'
+YTDLP_WHEEL_DIR = os.getenv('YTDLP_WHEEL_DIR')
+YTDLP_UPDATE_TIMEOUT = float(os.getenv('YTDLP_UPDATE_TIMEOUT', 300))
+YTDLP_DIR = os.getenv('YTDLP_DIR', 'yt-dlp')
+
+
+def installed_yt_dlp():
+    """The newest complete yt-dlp install under YTDLP_DIR, or None to use the one in site-packages."""
+    try:
+        names = sorted(name for name in os.listdir(YTDLP_DIR) if name.isdigit())
+    except FileNotFoundError:
+        return None
+    for name in reversed(names):
+        path = os.path.abspath(os.path.join(YTDLP_DIR, name))
+        if os.path.isdir(os.path.join(path, 'yt_dlp')):
+            return path
+    return None
+
+
+def _prune_yt_dlp(keep: set):
+    """Deletes yt-dlp installs except the two newest and the ones in keep, and abandoned partial installs."""
     try:
-        subprocess.check_call([
-            sys.executable, "-m", "pip", "install", "-U", "--pre", "yt-dlp[default]"
-        ])
-        print("yt-dlp updated successfully")
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to update yt-dlp: {e}")
-        # Decide whether to continue or exit based on your needs
+        names = sorted(os.listdir(YTDLP_DIR))
+    except FileNotFoundError:
+        return
+    installs = [name for name in names if name.isdigit()]
+    for name in installs[:-2]:
+        path = os.path.abspath(os.path.join(YTDLP_DIR, name))
+        if path not in keep:
+            logger.info(f'Deleting old yt-dlp install {path}')
+            shutil.rmtree(path, ignore_errors=True)
+    for name in names:
+        path = os.path.join(YTDLP_DIR, name)
+        if name.endswith('.tmp') and time.time() - os.path.getmtime(path) > YTDLP_UPDATE_TIMEOUT:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+async def update_yt_dlp():
+    """Installs the latest yt-dlp with pip without blocking the event loop.
+
+    It goes into a new directory under YTDLP_DIR, which is returned, or
+    None if the update failed. Extractor workers only load it when they
+    are reloaded, see ExtractionPool.reload.
+    """
+    os.makedirs(YTDLP_DIR, exist_ok=True)
+    await asyncio.get_running_loop().run_in_executor(None, _prune_yt_dlp, {extraction_pool.ytdl_path})
+    target = os.path.abspath(os.path.join(YTDLP_DIR, time.strftime('%Y%m%d%H%M%S')))
+    # Only renamed to its final name once pip is done, installed_yt_dlp() skips it until then.
+    # yt-dlp needs nothing outside the standard library, its optional
+    # dependencies are updated along with the rest of requirements.txt.
+    args = [sys.executable, "-m", "pip", "install", "--pre", "--no-deps", "--target", target + '.tmp', "yt-dlp"]
+    if YTDLP_WHEEL_DIR:
+        args[4:4] = ["--no-index", "--find-links", YTDLP_WHEEL_DIR]
+
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(*args,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.STDOUT)
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), timeout=YTDLP_UPDATE_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        logger.error(f'yt-dlp update timed out after {YTDLP_UPDATE_TIMEOUT:.0f} seconds')
+        shutil.rmtree(target + '.tmp', ignore_errors=True)
+        return None
+
+    if process.returncode != 0:
+        logger.error(f'Failed to update yt-dlp (exit code {process.returncode}): {output.decode(errors="replace")[-500:]}')
+        shutil.rmtree(target + '.tmp', ignore_errors=True)
+        return None
+
+    os.replace(target + '.tmp', target)
+    logger.info(f'yt-dlp updated successfully in {time.perf_counter() - started:.1f} seconds, installed in {target}')
+    return target
 
 
 nomention = discord.AllowedMentions.none()
 
 
 
-bot = commands.Bot(command_prefix=commands.when_mentioned_or(os.environ['COMMAND_PREFIX'],"/"),intents = discord.Intents().all(), description='Much better than fredboat', allowed_mentions=discord.AllowedMentions(roles=False, users=False, everyone=False))
+def build_intents(profile: str):
+    """Intents, member cache policy and whether to chunk guilds at startup for a profile."""
+    if profile == 'full':
+        intents = discord.Intents.all()
+        return intents, discord.MemberCacheFlags.from_intents(intents), True
+
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.voice_states = True
+    intents.messages = True
+    intents.message_content = True
+    # Only members in voice channels, enough for listener counts and the player
+    return intents, discord.MemberCacheFlags.from_intents(intents), False
+
+
+def create_bot() -> commands.Bot:
+    """Creates the bot and registers the events defined at the bottom of the file."""
+    intents, member_cache_flags, chunk_guilds = build_intents(INTENTS_PROFILE)
+    bot = commands.Bot(command_prefix=commands.when_mentioned_or(os.environ['COMMAND_PREFIX'],"/"),intents = intents, member_cache_flags=member_cache_flags, chunk_guilds_at_startup=chunk_guilds, description='Much better than fredboat', allowed_mentions=discord.AllowedMentions(roles=False, users=False, everyone=False))
+    bot.tree.add_command(app_commands.ContextMenu(name='Show Join Date', callback=show_join_date))
+    for event in (on_voice_state_update, on_guild_channel_create, on_guild_channel_delete,
+                  on_guild_channel_update, on_ready):
+        bot.event(event)
+    return bot
+
+
+# Set by create_bot() when run as a script
+bot = None
 
 class VoiceError(Exception):
     pass
@@ -71,11 +298,1238 @@ class YTDLError(Exception):
     pass
 
 
-class YTDLSource(discord.PCMVolumeTransformer):
+class DownloadCache:
+    """Index of the downloads directory keyed by extractor and video id.
+
+    Entries are kept in least-recently-used order and evicted once the
+    directory grows past max_bytes. Pinned entries (queued or playing songs)
+    are never evicted.
+    """
+
+    # Left behind by downloads that never finished
+    PARTIAL_SUFFIXES = ('.part', '.ytdl', '.temp')
+
+    def __init__(self, directory: str, max_bytes: int, index_path: str):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = index_path
+
+        self.entries = collections.OrderedDict()
+        self.pins = collections.Counter()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Reads the index and the directory, called once on startup."""
+        with self._lock:
+            self._load()
+
+    @staticmethod
+    def make_key(info: dict) -> str:
+        extractor = info.get('extractor') or info.get('ie_key') or 'generic'
+        return '{}-{}'.format(extractor.lower(), info.get('id'))
+
+    def _load(self):
+        index = {}
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f'Could not read download cache index, starting empty: {e}')
+
+        for key, entry in sorted(index.items(), key=lambda item: item[1].get('last_used', 0)):
+            if not os.path.exists(entry.get('path', '')):
+                continue
+            entry['size'] = os.path.getsize(entry['path'])
+            self.entries[key] = entry
+            self.total_bytes += entry['size']
+
+        adopted = self._scan()
+        logger.info(f'Loaded download cache: {len(self.entries)} files, {self.total_bytes} bytes')
+        if adopted:
+            self._evict()
+            self.save()
+
+    def _scan(self) -> int:
+        """Adopts files in the directory that the index doesn't know about.
+
+        Files from before the index existed, or from a crash before it was
+        saved, would otherwise fill the disk without ever being evicted.
+        They go in as the least recently used entries. Partial downloads
+        are deleted. Returns the number of files adopted.
+        """
+        tracked = {os.path.abspath(entry['path']) for entry in self.entries.values()}
+        tracked.update((os.path.abspath(self.index_path), os.path.abspath(self.index_path + '.tmp')))
+
+        adopted = []
+        try:
+            files = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        except OSError as e:
+            logger.warning(f'Could not scan {self.directory}: {e}')
+            return 0
+
+        for file in files:
+            path = os.path.join(self.directory, file.name)
+            if os.path.abspath(path) in tracked:
+                continue
+            if file.name.endswith(self.PARTIAL_SUFFIXES):
+                logger.info(f'Deleting partial download {path}')
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning(f'Could not delete partial download {path}: {e}')
+                continue
+
+            stat = file.stat()
+            if file.name.endswith('.audio'):
+                # Progressive downloads are named after their key
+                key = file.name[:-len('.audio')]
+            else:
+                # The key can't be told from the file name, it is only kept for eviction
+                key = 'untracked-' + file.name
+            if key in self.entries:
+                key = 'untracked-' + file.name
+            adopted.append((key, {'path': path, 'size': stat.st_size, 'hits': 0, 'last_used': stat.st_mtime}))
+
+        if adopted:
+            adopted.sort(key=lambda item: item[1]['last_used'])
+            entries = collections.OrderedDict(adopted)
+            entries.update(self.entries)
+            self.entries = entries
+            self.total_bytes += sum(entry['size'] for _, entry in adopted)
+            logger.info(f'Adopted {len(adopted)} untracked files into the download cache')
+        return len(adopted)
+
+    def save(self):
+        with self._lock:
+            index = dict(self.entries)
+            tmp_path = self.index_path + '.tmp'
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(index, f)
+                os.replace(tmp_path, self.index_path)
+            except OSError as e:
+                logger.warning(f'Could not write download cache index: {e}')
+
+    def lookup(self, key: str):
+        """Returns the cached file path for key, or None on a miss."""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry and not os.path.exists(entry['path']):
+                logger.warning(f'Cached file for {key} disappeared: {entry["path"]}')
+                self._drop(key)
+                entry = None
+
+            if not entry:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            entry['hits'] = entry.get('hits', 0) + 1
+            entry['last_used'] = time.time()
+            self.entries.move_to_end(key)
+            return entry['path']
+
+    def add(self, key: str, path: str):
+        """Records a freshly downloaded file and evicts old ones if over budget."""
+        with self._lock:
+            if key in self.entries:
+                self._drop(key, delete=False)
+
+            size = os.path.getsize(path)
+            self.entries[key] = {'path': path, 'size': size, 'hits': 0, 'last_used': time.time()}
+            self.total_bytes += size
+            self._evict(keep=key)
+        self.save()
+
+    def pin(self, key: str):
+        with self._lock:
+            self.pins[key] += 1
+
+    def unpin(self, key: str):
+        with self._lock:
+            self.pins[key] -= 1
+            if self.pins[key] <= 0:
+                del self.pins[key]
+
+    def _drop(self, key: str, delete: bool = True):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry['size']
+        if delete:
+            try:
+                os.remove(entry['path'])
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f'Could not delete cached file {entry["path"]}: {e}')
+
+    def _evict(self, keep: str = None):
+        for key in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key == keep or self.pins[key] > 0:
+                continue
+            logger.info(f'Evicting {key} from download cache ({self.entries[key]["size"]} bytes)')
+            self._drop(key)
+            self.evictions += 1
+
+        if self.total_bytes > self.max_bytes:
+            logger.warning(f'Download cache over budget ({self.total_bytes}/{self.max_bytes} bytes), all remaining files are pinned')
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'files': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'pinned': len(self.pins),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+
+download_cache = DownloadCache(DOWNLOADS_DIR, CACHE_MAX_BYTES, CACHE_INDEX_PATH)
+
+
+class MetadataCache:
+    """SQLite cache of search query -> video and video -> trimmed info dict.
+
+    Both mappings expire after their own TTL. Only the fields a
+    ResolvedTrack reads are stored, not the full yt-dlp info dict.
+    """
+
+    FIELDS = ('id', 'extractor', 'title', 'uploader', 'uploader_url', 'thumbnail',
+              'duration', 'webpage_url', 'url', 'http_headers', 'acodec')
+
+    def __init__(self, path: str, query_ttl: int, info_ttl: int):
+        self.query_ttl = query_ttl
+        self.info_ttl = info_ttl
+        self.hits = 0
+        self.misses = 0
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+
+    def open(self):
+        """Opens the database and purges expired rows, called once on startup."""
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS queries '
+                             '(query TEXT PRIMARY KEY, key TEXT NOT NULL, expires REAL NOT NULL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS infos '
+                             '(key TEXT PRIMARY KEY, info TEXT NOT NULL, expires REAL NOT NULL)')
+            now = time.time()
+            self._db.execute('DELETE FROM queries WHERE expires < ?', (now,))
+            self._db.execute('DELETE FROM infos WHERE expires < ?', (now,))
+
+    @classmethod
+    def trim(cls, info: dict) -> dict:
+        return {field: info[field] for field in cls.FIELDS if info.get(field) is not None}
+
+    def get(self, query: str):
+        """Returns the trimmed info dict cached for query, or None."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT infos.info FROM queries JOIN infos ON queries.key = infos.key '
+                'WHERE queries.query = ? AND queries.expires >= ? AND infos.expires >= ?',
+                (query, now, now)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, query: str, info: dict):
+        now = time.time()
+        key = DownloadCache.make_key(info)
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO queries VALUES (?, ?, ?)',
+                             (query, key, now + self.query_ttl))
+            self._db.execute('INSERT OR REPLACE INTO infos VALUES (?, ?, ?)',
+                             (key, json.dumps(self.trim(info)), now + self.info_ttl))
+
+    def stats(self) -> dict:
+        with self._lock:
+            queries = self._db.execute('SELECT COUNT(*) FROM queries').fetchone()[0]
+            infos = self._db.execute('SELECT COUNT(*) FROM infos').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'queries': queries,
+            'infos': infos,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+metadata_cache = MetadataCache(METADATA_DB_PATH, QUERY_CACHE_TTL, INFO_CACHE_TTL)
+
+
+class ExtractionPool:
+    """Runs yt-dlp jobs on dedicated workers, each with its own YoutubeDL.
+
+    Waiting jobs sit in per-guild queues that are served round-robin, so a
+    burst of searches from one guild can't hold up everyone else. Downloads
+    have workers of their own, so long downloads can't hold up lookups.
+
+    The workers can be replaced by a new generation with new options and,
+    in process mode, the latest yt-dlp install, see reload().
+    """
+
+    LOOKUP = 'lookup'
+    DOWNLOAD = 'download'
+
+    def __init__(self, workers: int, download_workers: int, mode: str, max_pending: int, max_pending_per_guild: int):
+        self.workers = workers
+        self.download_workers = download_workers
+        self.limits = {self.LOOKUP: workers, self.DOWNLOAD: download_workers}
+        self.mode = mode
+        self.max_pending = max_pending
+        self.max_pending_per_guild = max_pending_per_guild
+
+        self.executor = None
+        self.generation = 0
+        self.options = None
+        self.ytdl_class = None
+        # The yt-dlp install under YTDLP_DIR the workers run, None for site-packages
+        self.ytdl_path = None
+        # A newer install thread workers can't switch to, it is loaded after a restart
+        self.held_back = None
+        self.version = None
+        self.draining = 0
+        self._reloading = False
+        self.pending = {lane: collections.OrderedDict() for lane in self.limits}
+        self.queued = 0
+        self.active = {lane: 0 for lane in self.limits}
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+    def _make_executor(self, generation: int, options: dict, ytdl_class, path: str):
+        initargs = (generation, options, ytdl_class, path)
+        max_workers = self.workers + self.download_workers
+        if self.mode == 'process':
+            # spawn instead of fork, the bot process has voice and executor threads running.
+            # Each process imports yt-dlp itself, so the class isn't sent over.
+            return concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(generation, options, None, path))
+        return concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='ytdl-{}'.format(generation),
+            initializer=_init_worker,
+            initargs=initargs)
+
+    async def start(self):
+        """Reads the options, loads yt-dlp and creates the first workers without blocking the event loop."""
+        if self.executor is not None:
+            return
+        loop = asyncio.get_running_loop()
+        options = await loop.run_in_executor(None, load_ytdl_options)
+        path = await loop.run_in_executor(None, installed_yt_dlp)
+        ytdl_class = None
+        if self.mode == 'thread':
+            # Nothing runs yt-dlp yet, the one time it can be imported from the install
+            ytdl_class = await loop.run_in_executor(None, _load_youtubedl, path)
+        if self.executor is None:
+            self._start(options, ytdl_class, path)
+
+    def _start(self, options: dict, ytdl_class, path: str):
+        self.options = options
+        self.ytdl_class = ytdl_class
+        self.ytdl_path = path
+        self.executor = self._make_executor(self.generation, options, ytdl_class, path)
+
+    def submit(self, guild_id: int, fn, *args, timeout: float, lane: str = LOOKUP) -> asyncio.Future:
+        """Queues fn(*args) for a worker and returns a future for its result.
+
+        The timeout counts from now, time spent waiting for a worker included.
+        """
+        loop = asyncio.get_running_loop()
+        pending = self.pending[lane]
+        jobs = pending.get(guild_id)
+
+        if self.queued >= self.max_pending or (jobs and len(jobs) >= self.max_pending_per_guild):
+            self.rejected += 1
+            raise YTDLError('Too many songs are being looked up right now, try again in a moment.')
+
+        if self.executor is None:
+            # Only for a job that comes in before start() is done, this loads yt-dlp on the loop
+            path = installed_yt_dlp()
+            self._start(self.options or load_ytdl_options(),
+                        _load_youtubedl(path) if self.mode == 'thread' else None,
+                        path)
+
+        future = loop.create_future()
+        timer = loop.call_later(timeout, self._time_out, future, fn, timeout)
+        future.add_done_callback(lambda _: timer.cancel())
+        if jobs is None:
+            jobs = pending[guild_id] = collections.deque()
+        jobs.append((future, fn, args))
+        self.queued += 1
+
+        self._dispatch(lane)
+        return future
+
+    def _time_out(self, future: asyncio.Future, fn, timeout: float):
+        if future.done():
+            return
+        # A worker running it can't be interrupted, it keeps its slot until it finishes
+        self.timeouts += 1
+        logger.warning(f'{fn.__name__} timed out after {timeout} seconds')
+        future.set_exception(YTDLError('Timed out after {} seconds'.format(int(timeout))))
+
+    def _dispatch(self, lane: str):
+        pending = self.pending[lane]
+        while self.active[lane] < self.limits[lane] and pending:
+            guild_id, jobs = next(iter(pending.items()))
+            future, fn, args = jobs.popleft()
+            self.queued -= 1
+
+            # Send the guild to the back of the rotation
+            del pending[guild_id]
+            if jobs:
+                pending[guild_id] = jobs
+
+            if future.done():
+                # Caller gave up or it timed out while waiting
+                continue
+
+            self.active[lane] += 1
+            asyncio.get_running_loop().create_task(self._run(future, fn, args, lane))
+
+    async def _run(self, future: asyncio.Future, fn, args, lane: str):
+        loop = asyncio.get_running_loop()
+        work = loop.run_in_executor(self.executor, fn, *args)
+        work.add_done_callback(functools.partial(self._on_worker_free, lane))
+
+        await asyncio.wait({work})
+        if future.done():
+            return
+
+        if work.exception():
+            self.failed += 1
+            future.set_exception(work.exception())
+        else:
+            self.completed += 1
+            future.set_result(work.result())
+
+    def _on_worker_free(self, lane: str, work):
+        self.active[lane] -= 1
+        self._dispatch(lane)
+
+    async def reload(self, options: dict = None) -> str:
+        """Switches to a new generation of workers, returns its yt-dlp version.
+
+        Options are read again from YTDL_OPTIONS_PATH. In process mode the
+        new processes import the latest install under YTDLP_DIR. Worker
+        threads share the bot's imports, which can't change under running
+        jobs, so thread mode keeps its yt-dlp until a restart and leaves a
+        newer install in held_back. The new
+        workers are checked before any job is sent to them, so a broken
+        update or options file leaves the current generation in place. Jobs
+        already running finish on the old workers, which shut down once
+        they are done.
+        """
+        if self._reloading:
+            raise YTDLError('The extractor is already being reloaded.')
+        self._reloading = True
+        loop = asyncio.get_running_loop()
+        try:
+            if options is None:
+                options = await loop.run_in_executor(None, load_ytdl_options)
+            path = await loop.run_in_executor(None, installed_yt_dlp)
+            ytdl_class = None
+            held_back = None
+            if self.mode == 'thread':
+                ytdl_class = self.ytdl_class
+                if self.executor is None and not self.draining:
+                    # No worker has run yet, still safe to import
+                    ytdl_class = await loop.run_in_executor(None, _load_youtubedl, path)
+                elif path != self.ytdl_path:
+                    logger.warning(f'yt-dlp in {path} is used after a restart, thread workers keep their version')
+                    held_back, path = path, self.ytdl_path
+
+            generation = self.generation + 1
+            executor = self._make_executor(generation, options, ytdl_class, path)
+            try:
+                version = await asyncio.wait_for(loop.run_in_executor(executor, _check_worker),
+                                                 timeout=EXTRACT_TIMEOUT)
+            except BaseException:
+                executor.shutdown(wait=False)
+                raise
+
+            old, self.executor = self.executor, executor
+            self.generation = generation
+            self.options = options
+            self.ytdl_class = ytdl_class
+            self.ytdl_path = path
+            self.held_back = held_back
+            self.version = version
+        finally:
+            self._reloading = False
+
+        logger.info(f'Extractor generation {generation} running yt-dlp {version}')
+        if old is not None:
+            self.draining += 1
+            loop.create_task(self._drain(old, generation - 1))
+        return version
+
+    @property
+    def player_clients(self) -> list:
+        """The YouTube player clients in the current options, in their configured order."""
+        if self.options is None:
+            self.options = load_ytdl_options()
+        return list(self.options.get('extractor_args', {}).get('youtube', {}).get('player_client', []))
+
+    async def _drain(self, executor, generation: int):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, functools.partial(executor.shutdown, wait=True))
+        finally:
+            self.draining -= 1
+        logger.info(f'Extractor generation {generation} drained and shut down')
+
+    def stats(self) -> dict:
+        return {
+            'mode': self.mode,
+            'generation': self.generation,
+            'version': self.version,
+            'draining': self.draining,
+            'workers': self.workers,
+            'download_workers': self.download_workers,
+            'active': self.active[self.LOOKUP],
+            'downloading': self.active[self.DOWNLOAD],
+            'queued': self.queued,
+            'guilds_waiting': len(set().union(*self.pending.values())),
+            'completed': self.completed,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'rejected': self.rejected,
+        }
+
+
+class SingleFlight:
+    """Lets concurrent callers asking for the same key share one in-flight call."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = {}
+        self.waiters = collections.Counter()
+        self.started = 0
+        self.shared = 0
+        self.abandoned = 0
+
+    async def do(self, key, coro_factory, abandon=None):
+        """Awaits coro_factory() (a coroutine or future) or, if one is already running for key, its result.
+
+        If the last caller waiting on it gives up and abandon() returns
+        True, the call is cancelled instead of left to finish for nobody.
+        """
+        task = self.calls.get(key)
+        if task is None:
+            self.started += 1
+            task = asyncio.ensure_future(coro_factory())
+            self.calls[key] = task
+            task.add_done_callback(functools.partial(self._finished, key))
+        else:
+            self.shared += 1
+            logger.info(f'Joining in-flight {self.name} for {key}')
+
+        self.waiters[key] += 1
+        try:
+            # Shielded so one caller giving up doesn't cancel it for the others
+            return await asyncio.shield(task)
+        finally:
+            self.waiters[key] -= 1
+            if not self.waiters[key]:
+                del self.waiters[key]
+                if not task.done() and abandon is not None and abandon():
+                    logger.info(f'Abandoning {self.name} for {key}, nobody is waiting for it')
+                    self.abandoned += 1
+                    task.cancel()
+
+    def _finished(self, key, task: asyncio.Task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            # Mark the error as seen even if every caller has gone away
+            task.exception()
+
+
+# Identical concurrent searches share one lookup, the same video shares one download
+resolve_flights = SingleFlight('lookup')
+download_flights = SingleFlight('download')
+
+
+class PlayerClients:
+    """Tries YouTube player clients one by one, ordered by how they have been doing.
+
+    Each client's recent tries (success and worker time) are kept for
+    CLIENT_WINDOW seconds. Clients with enough samples go first, cheapest
+    expected time to a result first, the rest follow in configured order.
+    A client failing too often is skipped for a while, then starts over
+    with a clean record.
+    """
+
+    def __init__(self):
+        self.samples = {}
+        self.skipped_until = {}
+        self.skips = collections.Counter()
+
+    def _recent(self, client: str) -> collections.deque:
+        samples = self.samples.setdefault(client, collections.deque(maxlen=200))
+        cutoff = time.monotonic() - CLIENT_WINDOW
+        while samples and samples[0][0] < cutoff:
+            samples.popleft()
+        return samples
+
+    def record(self, client: str, ok: bool, seconds: float):
+        samples = self._recent(client)
+        samples.append((time.monotonic(), ok, seconds))
+
+        if len(samples) >= CLIENT_MIN_SAMPLES:
+            rate = sum(ok for _, ok, _ in samples) / len(samples)
+            if rate < CLIENT_SKIP_RATE:
+                logger.warning(f'Player client {client} succeeded {rate:.0%} of {len(samples)} recent tries, skipping it for {CLIENT_SKIP_SECONDS:.0f} seconds')
+                self.skipped_until[client] = time.monotonic() + CLIENT_SKIP_SECONDS
+                self.skips[client] += 1
+                samples.clear()
+
+    def _cost(self, client: str):
+        """Expected worker seconds to get a result, None without enough samples."""
+        samples = self._recent(client)
+        if len(samples) < CLIENT_MIN_SAMPLES:
+            return None
+        successes = [seconds for _, ok, seconds in samples if ok]
+        if not successes:
+            return float('inf')
+        return (sum(successes) / len(successes)) * len(samples) / len(successes)
+
+    def order(self, clients: list) -> list:
+        now = time.monotonic()
+        usable = [client for client in clients if self.skipped_until.get(client, 0) <= now]
+        if not usable:
+            # Everything is failing, better to keep trying than to give up
+            usable = list(clients)
+
+        def key(client):
+            cost = self._cost(client)
+            return (cost is None, cost or 0, clients.index(client))
+        return sorted(usable, key=key)
+
+    async def run(self, guild_id: int, fn, query: str, *args, timeout: float, lane: str = ExtractionPool.LOOKUP):
+        """Runs the worker job fn(query, client, *args) on the extraction pool, falling back through the clients.
+
+        Errors about the video itself are raised right away, without trying
+        other clients or counting against the one that reported them.
+        """
+        clients = extraction_pool.player_clients
+        if not clients or not is_youtube_query(query):
+            return await extraction_pool.submit(guild_id, fn, query, None, *args, timeout=timeout, lane=lane)
+
+        # The timeout covers all the clients tried, not each of them
+        deadline = time.monotonic() + timeout
+        last_error = None
+        for client in self.order(clients):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            started = time.perf_counter()
+            # A full pool raises here and is not the client's fault
+            work = extraction_pool.submit(guild_id, _timed_job, fn, query, client, *args, timeout=remaining, lane=lane)
+            try:
+                seconds, result, video_error = await work
+            except Exception as e:
+                self.record(client, False, time.perf_counter() - started)
+                logger.warning(f'Player client {client} failed for {query}: {e}')
+                last_error = e
+                continue
+
+            if video_error:
+                # Unavailable, private or removed, no other client will do better
+                logger.info(f'{query} can\'t be played: {video_error}')
+                raise YTDLError(video_error)
+            self.record(client, True, seconds)
+            return result
+
+        raise last_error or YTDLError('Timed out after {} seconds'.format(int(timeout)))
+
+    def stats(self) -> list:
+        now = time.monotonic()
+        clients = extraction_pool.player_clients
+        ordered = self.order(clients)
+        # Skipped clients last
+        ordered += [client for client in clients if client not in ordered]
+        rows = []
+        for client in ordered:
+            samples = self._recent(client)
+            successes = [seconds for _, ok, seconds in samples if ok]
+            rows.append({
+                'client': client,
+                'tries': len(samples),
+                'success': len(successes) / len(samples) if samples else None,
+                'latency': sum(successes) / len(successes) if successes else None,
+                'skipped_for': max(0, self.skipped_until.get(client, 0) - now),
+                'skips': self.skips[client],
+            })
+        return rows
+
+
+player_clients = PlayerClients()
+
+
+class DownloadScheduler:
+    """Limits how many downloads run at once and splits the bandwidth budget between them.
+
+    Waiting downloads start by priority, the song about to play before
+    prefetches, and in arrival order within a priority.
+    """
+
+    NEXT = 0
+    PREFETCH = 1
+
+    def __init__(self, concurrency: int, bandwidth: float):
+        self.concurrency = concurrency
+        self.bandwidth = bandwidth
+        self.active = 0
+        # Heap of [priority, arrival, key, future], future is None once superseded by promote()
+        self.waiting = []
+        self.entries = {}
+        self._arrivals = itertools.count()
+        # (title, bytes, seconds) of recent downloads
+        self.recent = collections.deque(maxlen=20)
+        self.completed = 0
+        self.total_bytes = 0
+        self.total_seconds = 0.0
+
+    def params(self) -> dict:
+        """YoutubeDL params for one download slot."""
+        return {
+            'ratelimit': self.bandwidth / self.concurrency if self.bandwidth else None,
+            'concurrent_fragment_downloads': DOWNLOAD_FRAGMENTS,
+            'http_chunk_size': DOWNLOAD_CHUNK_SIZE,
+        }
+
+    async def acquire(self, key: str, priority: int):
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._arrivals), key, future]
+        heapq.heappush(self.waiting, entry)
+        self.entries[key] = entry
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Got the slot just as it was cancelled
+                self.release()
+            raise
+        finally:
+            if self.entries.get(key) and self.entries[key][3] is future:
+                del self.entries[key]
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    def is_waiting(self, key: str) -> bool:
+        """True while the download for key is queued for a slot and hasn't started."""
+        return key in self.entries
+
+    def _wake(self):
+        while self.active < self.concurrency and self.waiting:
+            future = heapq.heappop(self.waiting)[3]
+            if future is None or future.done():
+                continue
+            self.active += 1
+            future.set_result(None)
+
+    def promote(self, key: str):
+        """Moves a waiting download ahead of the prefetches, when its song is up next."""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= self.NEXT:
+            return
+        promoted = [self.NEXT, next(self._arrivals), key, entry[3]]
+        entry[3] = None
+        heapq.heappush(self.waiting, promoted)
+        self.entries[key] = promoted
+        logger.info(f'Download of {key} moved ahead of prefetches')
+
+    def record(self, title: str, size: int, seconds: float):
+        self.recent.append((title, size, seconds))
+        self.completed += 1
+        self.total_bytes += size
+        self.total_seconds += seconds
+        logger.info(f'Downloaded "{title}": {size / 1048576:.1f} MB in {seconds:.1f}s ({size / 1048576 / max(seconds, 0.001):.2f} MB/s)')
+
+    def stats(self) -> dict:
+        return {
+            'active': self.active,
+            'concurrency': self.concurrency,
+            'waiting': len(self.entries),
+            'completed': self.completed,
+            'throughput': self.total_bytes / 1048576 / self.total_seconds if self.total_seconds else 0.0,
+            'bandwidth': '{:.1f} MB/s'.format(self.bandwidth / 1048576) if self.bandwidth else 'unlimited',
+        }
+
+
+download_scheduler = DownloadScheduler(DOWNLOAD_CONCURRENCY, DOWNLOAD_BANDWIDTH)
+
+
+def normalize_query(search: str) -> str:
+    search = search.strip()
+    if urllib.parse.urlparse(search).scheme in ('http', 'https'):
+        # Video ids in URLs are case sensitive
+        return search
+    return ' '.join(search.lower().split())
+
+
+def deep_sizeof(obj, seen: set = None) -> int:
+    """Approximate bytes held by obj and the containers and strings inside it."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+# Sizes of the full info dicts seen by sampled lookups, what each queued song used to hold
+info_dict_sizes = collections.deque(maxlen=100)
+
+# Downloads get as many workers of their own as the scheduler lets run at once
+extraction_pool = ExtractionPool(EXTRACT_WORKERS, DOWNLOAD_CONCURRENCY, EXTRACT_MODE, EXTRACT_QUEUE_DEPTH, EXTRACT_GUILD_DEPTH)
+
+# Each worker thread (or process) keeps its own YoutubeDL, they are not safe to share
+_worker_local = threading.local()
+
+
+def load_ytdl_options() -> dict:
+    """YTDLSource.YTDL_OPTIONS with the overrides in YTDL_OPTIONS_PATH, if that exists."""
+    try:
+        with open(YTDL_OPTIONS_PATH, 'r', encoding='utf-8') as f:
+            overrides = json.load(f)
+    except FileNotFoundError:
+        return YTDLSource.YTDL_OPTIONS
+    return _merge_options(YTDLSource.YTDL_OPTIONS, overrides)
+
+
+def _merge_options(base: dict, overrides: dict) -> dict:
+    merged = dict(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = _merge_options(merged[key], value)
+        merged[key] = value
+    return merged
+
+
+def _load_youtubedl(path: str = None):
+    """Imports yt-dlp from an install under YTDLP_DIR and returns its YoutubeDL class.
+
+    Only safe while nothing in this interpreter runs yt-dlp, it imports
+    extractors lazily and would pick them up from the new version. That
+    holds in a fresh extractor process and before the first worker thread.
+    """
+    if path is None:
+        return YoutubeDL
+    installs = os.path.abspath(YTDLP_DIR)
+    sys.path[:] = [entry for entry in sys.path if os.path.dirname(entry) != installs]
+    sys.path.insert(0, path)
+    for name in [name for name in sys.modules if name == 'yt_dlp' or name.startswith('yt_dlp.')]:
+        del sys.modules[name]
+    importlib.invalidate_caches()
+    return importlib.import_module('yt_dlp').YoutubeDL
+
+
+def _init_worker(generation: int, options: dict, ytdl_class, path: str = None):
+    """Runs in each new worker thread or process, before its first job."""
+    _worker_local.generation = generation
+    _worker_local.options = options
+    # Extractor processes load the install themselves
+    _worker_local.ytdl_class = ytdl_class or _load_youtubedl(path)
+    _worker_local.ytdls = {}
+
+
+def _check_worker() -> str:
+    """Worker job: builds the YoutubeDL and returns the yt-dlp version it runs."""
+    _worker_ytdl()
+    return importlib.import_module('yt_dlp.version').__version__
+
+
+def _job_options(flat: bool = False, client: str = None) -> dict:
+    options = _worker_local.options
+    if flat:
+        options = dict(options, **YTDLSource.YTDL_FLAT_OVERRIDES)
+    if client:
+        extractor_args = options.get('extractor_args', {})
+        youtube = dict(extractor_args.get('youtube', {}), player_client=[client])
+        options = dict(options, extractor_args=dict(extractor_args, youtube=youtube))
+    return options
+
+
+def _worker_ytdl(flat: bool = False, client: str = None) -> YoutubeDL:
+    """This worker's YoutubeDL, for flat playlist listing and/or limited to one YouTube player client."""
+    ytdl = _worker_local.ytdls.get((flat, client))
+    if ytdl is None:
+        ytdl = _worker_local.ytdls[(flat, client)] = _worker_local.ytdl_class(_job_options(flat, client))
+    return ytdl
+
+
+# Parts of yt-dlp's expected errors that depend on the player client, not the video
+CLIENT_ERROR_HINTS = ('sign in', 'captcha', 'try again later', 'not a bot')
+
+
+def _video_error(error: Exception):
+    """The message of a yt-dlp error about the video itself, None if another client might get past it."""
+    utils = importlib.import_module('yt_dlp.utils')
+    cause = error
+    if isinstance(error, utils.DownloadError) and error.exc_info:
+        # What the extractor raised, wrapped by YoutubeDL
+        cause = error.exc_info[1]
+    if not isinstance(cause, utils.ExtractorError) or not cause.expected:
+        return None
+    message = str(cause)
+    if isinstance(cause, (utils.GeoRestrictedError, utils.UnsupportedError)):
+        return message
+    if any(hint in message.lower() for hint in CLIENT_ERROR_HINTS):
+        return None
+    return message
+
+
+def _timed_job(fn, *args):
+    """Worker job: runs fn(*args) and returns how long it took, its result and any error about the video.
+
+    Errors about the video itself (private, removed, unsupported...) come
+    back as a message instead of being raised, yt-dlp's exceptions lose
+    their details when sent back from an extractor process.
+    """
+    started = time.perf_counter()
+    try:
+        result = fn(*args)
+    except Exception as e:
+        message = _video_error(e)
+        if message is None:
+            raise
+        return time.perf_counter() - started, None, message
+    return time.perf_counter() - started, result, None
+
+
+def is_youtube_query(search: str) -> bool:
+    """True for YouTube links and for plain searches, which default_search sends to YouTube."""
+    url = urllib.parse.urlparse(search.strip())
+    if url.scheme not in ('http', 'https'):
+        return True
+    host = url.hostname or ''
+    return host == 'youtu.be' or host == 'youtube.com' or host.endswith('.youtube.com')
+
+
+def _extract_job(search: str, client: str = None) -> dict:
+    """Worker job: resolves metadata without downloading."""
+    ytdl = _worker_ytdl(client=client)
+    data = ytdl.extract_info(search, download=False)
+    # Plain data only, so results can come back from a worker process
+    return ytdl.sanitize_info(data) if data is not None else None
+
+
+def _playlist_job(url: str, start: int, end: int) -> dict:
+    """Worker job: lists entries start to end (1-based, inclusive) of a playlist.
+
+    Entries are flat (not resolved one by one) and trimmed to the fields a
+    ResolvedTrack reads.
+    """
+    ytdl = _worker_ytdl(flat=True)
+    # Safe to change per call, every worker has its own instance
+    ytdl.params['playlist_items'] = '{}-{}'.format(start, end)
+    data = ytdl.extract_info(url, download=False)
+    if data is None:
+        return None
+
+    raw_entries = list(data.get('entries') or [])
+    entries = []
+    for entry in raw_entries:
+        if not entry:
+            continue
+        thumbnails = entry.get('thumbnails') or [{}]
+        entries.append(MetadataCache.trim({
+            'id': entry.get('id'),
+            'extractor': entry.get('ie_key') or entry.get('extractor'),
+            'title': entry.get('title'),
+            'uploader': entry.get('uploader') or entry.get('channel'),
+            'uploader_url': entry.get('uploader_url') or entry.get('channel_url'),
+            'duration': entry.get('duration'),
+            'webpage_url': entry.get('webpage_url') or entry.get('url'),
+            'thumbnail': thumbnails[-1].get('url'),
+        }))
+
+    return {
+        'title': data.get('title'),
+        'count': data.get('playlist_count'),
+        'returned': len(raw_entries),
+        'entries': entries,
+    }
+
+
+def is_playlist_query(search: str) -> bool:
+    """True for links to a playlist itself, not a video that happens to be in one."""
+    url = urllib.parse.urlparse(search.strip())
+    if url.scheme not in ('http', 'https'):
+        return False
+
+    params = urllib.parse.parse_qs(url.query)
+    if 'list' in params and 'v' not in params:
+        return True
+    return url.path.rstrip('/').endswith('/playlist') or '/sets/' in url.path
+
+
+def _download_job(url: str, client: str = None, params: dict = None, path: str = None) -> str:
+    """Worker job: downloads the song at url and returns the local file path.
+
+    With path, the audio is saved there in its original format, skipping
+    the mp3 conversion, so it can be played while it downloads.
+    """
+    if path:
+        # Its own instance, the output template is per download
+        ytdl = _worker_local.ytdl_class(dict(_job_options(client=client),
+                                             outtmpl=path.replace('%', '%%'),
+                                             postprocessors=[],
+                                             **(params or {})))
+    else:
+        ytdl = _worker_ytdl(client=client)
+        # Bandwidth share and fragment settings from the scheduler, safe to
+        # change per call since every worker has its own instance
+        ytdl.params.update(params or {})
+    info = ytdl.extract_info(url, download=True)
+    if info is None:
+        raise YTDLError('Couldn\'t download `{}`'.format(url))
+    if 'entries' in info:
+        info = next((entry for entry in info['entries'] if entry), None)
+        if info is None:
+            raise YTDLError('Couldn\'t download `{}`'.format(url))
+
+    # Get the downloaded filename
+    filename = ytdl.prepare_filename(info)
+    logger.debug(f'prepare_filename returned: {filename}')
+
+    # If postprocessor changed the extension to mp3, update filename
+    if 'requested_downloads' in info and info['requested_downloads']:
+        filename = info['requested_downloads'][0]['filepath']
+        logger.debug(f'Using requested_downloads path: {filename}')
+    elif not os.path.exists(filename):
+        # Try with .mp3 extension
+        base, ext = os.path.splitext(filename)
+        mp3_filename = base + '.mp3'
+        logger.debug(f'Original file not found, trying: {mp3_filename}')
+        if os.path.exists(mp3_filename):
+            filename = mp3_filename
+            logger.debug(f'Found mp3 file: {filename}')
+        else:
+            logger.warning(f'Could not find downloaded file. Tried: {filename} and {mp3_filename}')
+
+    if not os.path.exists(filename):
+        raise YTDLError(f'Downloaded file not found: {filename}')
+
+    logger.info(f'Successfully downloaded and located file: {filename} ({os.path.getsize(filename)} bytes)')
+    return filename
+
+
+class GrowingFile:
+    """File-like reader of a download in progress, fed to FFmpeg through a pipe.
+
+    read() waits for more data instead of returning b'' until the download
+    is over. yt-dlp renames the .part file when it finishes, an open handle
+    keeps reading the same file.
+    """
+
+    POLL = 0.1
+
+    def __init__(self, path: str, download: asyncio.Future):
+        self.path = path
+        self.finished = threading.Event()
+        self.closed = False
+        self._file = None
+        download.add_done_callback(lambda _: self.finished.set())
+
+    def _open(self):
+        for candidate in (self.path + '.part', self.path):
+            try:
+                return open(candidate, 'rb')
+            except FileNotFoundError:
+                continue
+        return None
+
+    def read(self, size: int) -> bytes:
+        # Runs on discord's pipe writer thread
+        while not self.closed:
+            if self._file is None:
+                self._file = self._open()
+            if self._file is not None:
+                data = self._file.read(size)
+                if data:
+                    return data
+            if self.finished.is_set():
+                # Whatever was written between the read and the check
+                if self._file is None:
+                    self._file = self._open()
+                data = self._file.read(size) if self._file else b''
+                if data:
+                    return data
+                break
+            time.sleep(self.POLL)
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return b''
+
+    def close(self):
+        """Makes the reader stop at its next read, playback is over."""
+        self.closed = True
+
+
+class GrowingFileAudio(discord.FFmpegPCMAudio):
+    """FFmpegPCMAudio fed from a GrowingFile through FFmpeg's stdin.
+
+    discord.py's pipe writer terminates FFmpeg as soon as the source runs
+    dry, throwing away the audio FFmpeg still has buffered. This one closes
+    stdin instead, so FFmpeg plays out the end of the song and exits.
+    """
+
+    def _pipe_writer(self, source: GrowingFile):
+        while self._process:
+            data = source.read(8192)
+            # cleanup() swaps these for discord's falsy MISSING sentinel
+            stdin = self._stdin
+            if not data:
+                if stdin:
+                    try:
+                        stdin.close()
+                    except OSError:
+                        pass
+                return
+            try:
+                stdin.write(data)
+            except Exception:
+                logger.debug(f'Write error feeding FFmpeg from {source.path}, playback probably stopped', exc_info=True)
+                process = self._process
+                if process:
+                    process.terminate()
+                return
+
+
+class TrackSource:
+    """Bookkeeping shared by the audio sources opened for a ResolvedTrack."""
+
+    # Every read() hands the voice client one frame of this many seconds
+    FRAME_SECONDS = discord.opus.Encoder.FRAME_LENGTH / 1000
+    # Seconds the audio thread waits for FFmpeg to exit after the audio ran out
+    EXIT_WAIT = 1.0
+
+    def _init_track(self, track: 'ResolvedTrack', cache_key: str, mode: str, start: float = 0.0):
+        self.cache_key = cache_key
+        self.mode = mode
+        self._released = False
+        self.start = start
+        self.frames = 0
+        # FFmpeg's exit status, saved by cleanup() before discord.py drops the process
+        self.returncode = None
+        self.ended = False
+        # Set once cleanup() ran, discord.py calls it on the audio thread right after `after`
+        self.closed = threading.Event()
+        # Set by PreparedAudio.open in progressive mode
+        self.download = None
+        self.growing = None
+
+        self.track = track
+        self.requester = track.requester
+        self.channel = track.channel
+
+    def __str__(self):
+        return str(self.track)
+
+    def read(self) -> bytes:
+        data = super().read()
+        if data:
+            self.frames += 1
+        else:
+            self.ended = True
+        return data
+
+    @property
+    def position(self) -> float:
+        """Seconds into the song, counted from the frames actually played."""
+        return self.start + self.frames * self.FRAME_SECONDS
+
+    def _ffmpeg_process(self):
+        return getattr(self, '_process', None)
+
+    def ffmpeg_failed(self) -> bool:
+        """True if FFmpeg exited with an error instead of finishing or being stopped."""
+        process = self._ffmpeg_process()
+        # After cleanup() the process is discord's MISSING sentinel, which is falsy
+        returncode = process.poll() if process else self.returncode
+        return (returncode or 0) > 0
+
+    def failed(self) -> bool:
+        """True if playback ended early because FFmpeg or the download feeding it failed."""
+        if self.download is not None and self.download.done():
+            if self.download.cancelled() or self.download.exception():
+                return True
+        return self.ffmpeg_failed()
+
+    def release(self):
+        """Unpins the cached file so it becomes eligible for eviction."""
+        if self.cache_key and not self._released:
+            self._released = True
+            download_cache.unpin(self.cache_key)
+
+    async def wait_closed(self, loop: asyncio.AbstractEventLoop):
+        """Waits off the loop until the audio thread has cleaned up and saved FFmpeg's exit status."""
+        await loop.run_in_executor(None, self.closed.wait, self.EXIT_WAIT + 1)
+
+    def cleanup(self):
+        self.release()
+        process = self._ffmpeg_process()
+        if process:
+            # Only the audio thread may block, cleanup() also runs on the loop when a song is dropped
+            on_player = isinstance(threading.current_thread(), discord.player.AudioPlayer)
+            try:
+                # FFmpeg closed its output, give it a moment to exit with its real status
+                self.returncode = process.wait(self.EXIT_WAIT) if self.ended and on_player else process.poll()
+            except subprocess.TimeoutExpired:
+                pass
+        if self.growing:
+            self.growing.close()
+        super().cleanup()
+        self.closed.set()
+
+
+class YTDLSource(TrackSource, discord.PCMVolumeTransformer):
     YTDL_OPTIONS = {
         'format': 'bestaudio/best',
         'extractaudio': True,
-        'audioformat': 'mp3',
+        # Opus files can be sent to Discord as they are, see OPUS_PASSTHROUGH
+        'audioformat': 'opus' if OPUS_PASSTHROUGH else 'mp3',
         'outtmpl': 'downloads/%(extractor)s-%(id)s-%(title)s.%(ext)s',
         'restrictfilenames': True,
         'noplaylist': True,
@@ -90,7 +1544,7 @@ class YTDLSource(discord.PCMVolumeTransformer):
         'keepvideo': False,
         'postprocessors': [{
             'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
+            'preferredcodec': 'opus' if OPUS_PASSTHROUGH else 'mp3',
             'preferredquality': '192',
         }],
         # Use iOS client to avoid 403 errors
@@ -102,96 +1556,290 @@ class YTDLSource(discord.PCMVolumeTransformer):
         },
     }
 
+    # Added to the options to list playlist entries without resolving each one
+    YTDL_FLAT_OVERRIDES = {'extract_flat': 'in_playlist', 'noplaylist': False}
+
     FFMPEG_OPTIONS = {
         'options': '-vn',
     }
 
-    ytdl = YoutubeDL(YTDL_OPTIONS)
+    FFMPEG_STREAM_OPTIONS = {
+        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+        'options': '-vn',
+    }
+
+    # Re-resolve stream URLs that expire within this many seconds
+    STREAM_URL_MARGIN = 60
 
     def __init__(self,
-                 ctx: commands.Context,
+                 track: 'ResolvedTrack',
                  source: discord.FFmpegPCMAudio,
                  *,
-                 data: dict,
-                 volume: float = 0.5):
-        super().__init__(source, volume)
-
-        self.requester = ctx.author
-        self.channel = ctx.channel
-        self.data = data
+                 volume: float = 1.0,
+                 cache_key: str = None,
+                 mode: str = 'download',
+                 start: float = 0.0):
+        self._init_track(track, cache_key, mode, start)
 
-        self.uploader = data.get('uploader')
-        self.uploader_url = data.get('uploader_url')
-        date = data.get('upload_date')
-        self.upload_date = date[6:8] + '.' + date[4:6] + '.' + date[0:4]
-        self.title = data.get('title')
-        self.thumbnail = data.get('thumbnail')
-        self.description = data.get('description')
-        self.duration = self.parse_duration(int(data.get('duration')))
-        self.tags = data.get('tags')
-        self.url = data.get('webpage_url')
-        self.views = data.get('view_count')
-        self.likes = data.get('like_count')
-        self.dislikes = data.get('dislike_count')
-        self.stream_url = data.get('url')
+        super().__init__(source, volume)
 
-    def __str__(self):
-        return '**{0.title}** by **{0.uploader}**'.format(self)
+    def _ffmpeg_process(self):
+        return getattr(self.original, '_process', None)
 
     @classmethod
-    async def create_source(cls,
-                            ctx: commands.Context,
-                            search: str,
-                            *,
-                            loop: asyncio.BaseEventLoop = None):
+    async def resolve(cls,
+                      ctx: commands.Context,
+                      search: str,
+                      *,
+                      loop: asyncio.BaseEventLoop = None) -> 'ResolvedTrack':
+        """Looks up track metadata without downloading anything."""
         loop = loop or asyncio.get_event_loop()
 
-        logger.info(f'Starting download for: {search}')
+        logger.info(f'Resolving: {search}')
 
-        # Download the file instead of streaming
-        partial = functools.partial(cls.ytdl.extract_info,
-                                    search,
-                                    download=True)
-        data = await loop.run_in_executor(None, partial)
+        query = normalize_query(search)
+        info = await resolve_flights.do(
+            query,
+            lambda: cls._lookup(query, ctx.guild.id, loop=loop))
 
-        if data is None:
+        if info is None:
             raise YTDLError(
                 'Couldn\'t find anything that matches `{}`'.format(search))
 
+        return ResolvedTrack(ctx, info)
+
+    @classmethod
+    async def _lookup(cls, query: str, guild_id: int, *, loop: asyncio.BaseEventLoop):
+        info = await loop.run_in_executor(None, metadata_cache.get, query)
+        if info is not None:
+            logger.info(f'Metadata cache hit for: {query}')
+            return info
+
+        data = await player_clients.run(guild_id,
+                                        _extract_job,
+                                        query,
+                                        timeout=EXTRACT_TIMEOUT)
+        if data is None:
+            return None
+
         if 'entries' in data:
             # Take first item from a playlist
-            info = data['entries'][0]
+            entries = list(data['entries'])
+            if not entries:
+                return None
+            info = entries[0]
             logger.debug(f'Got playlist entry: {info.get("title", "unknown")}')
         else:
             info = data
 
-        # Get the downloaded filename
-        filename = cls.ytdl.prepare_filename(info)
-        logger.debug(f'prepare_filename returned: {filename}')
-
-        # If postprocessor changed the extension to mp3, update filename
-        if 'requested_downloads' in info and info['requested_downloads']:
-            filename = info['requested_downloads'][0]['filepath']
-            logger.debug(f'Using requested_downloads path: {filename}')
-        elif not os.path.exists(filename):
-            # Try with .mp3 extension
-            base, ext = os.path.splitext(filename)
-            mp3_filename = base + '.mp3'
-            logger.debug(f'Original file not found, trying: {mp3_filename}')
-            if os.path.exists(mp3_filename):
-                filename = mp3_filename
-                logger.debug(f'Found mp3 file: {filename}')
-            else:
-                logger.warning(f'Could not find downloaded file. Tried: {filename} and {mp3_filename}')
+        if TRACK_MEMORY_SAMPLE and random.random() < TRACK_MEMORY_SAMPLE:
+            info_dict_sizes.append(await loop.run_in_executor(None, deep_sizeof, info))
+        await loop.run_in_executor(None, metadata_cache.put, query, info)
+        return info
+
+    @classmethod
+    async def prepare(cls,
+                      track: 'ResolvedTrack',
+                      *,
+                      loop: asyncio.BaseEventLoop = None,
+                      mode: str = None,
+                      priority: int = DownloadScheduler.PREFETCH) -> 'PreparedAudio':
+        """Gets a resolved track ready to be opened for playback.
+
+        In download mode the file is downloaded (or reused from the cache).
+        In stream mode the stream URL is used directly unless the file is
+        already cached, falling back to download mode if that fails.
+        In progressive mode playback can start before the download is done.
+        No FFmpeg process is started here, see PreparedAudio.open.
+        """
+        loop = loop or asyncio.get_event_loop()
+        mode = mode or PLAYBACK_MODE
+
+        cache_key = track.key
+        filename = download_cache.lookup(cache_key)
 
-        if not os.path.exists(filename):
-            raise YTDLError(f'Downloaded file not found: {filename}')
+        if filename:
+            logger.info(f'Download cache hit for {cache_key}: {filename}')
+        elif mode == 'stream':
+            try:
+                return await cls._prepare_stream(track, loop=loop)
+            except Exception as e:
+                logger.warning(f'Streaming "{track.title}" failed, falling back to download: {e}')
+
+        if not filename:
+            logger.info(f'Download cache miss for {cache_key}, starting download')
+            if priority == DownloadScheduler.NEXT:
+                # In case someone else's prefetch of it is still waiting
+                download_scheduler.promote(cache_key)
+            path = os.path.join(DOWNLOADS_DIR, cache_key + '.audio') if mode == 'progressive' else None
+            # Shared with anyone fetching the same video. Once every fetch
+            # waiting on it is cancelled, it is dropped if it is still queued
+            # for a slot. A download already running on a worker can't be
+            # interrupted, it finishes and caches the file.
+            download = asyncio.ensure_future(download_flights.do(
+                cache_key,
+                lambda: cls._download_and_index(track, cache_key, priority, path),
+                abandon=lambda: download_scheduler.is_waiting(cache_key)))
+            if path:
+                try:
+                    audio = await cls._prepare_progressive(track, path, download)
+                except asyncio.CancelledError:
+                    # asyncio.wait doesn't pass the cancellation on, stop waiting on the flight too
+                    download.cancel()
+                    raise
+                if audio:
+                    return audio
+            filename = await download
+
+        download_cache.pin(cache_key)
 
-        logger.info(f'Successfully downloaded and located file: {filename} ({os.path.getsize(filename)} bytes)')
+        try:
+            codec = await cls._probe_codec(filename)
+        except BaseException:
+            download_cache.unpin(cache_key)
+            raise
+        return PreparedAudio(track, filename, codec=codec, cache_key=cache_key)
 
-        return cls(ctx,
-                   discord.FFmpegPCMAudio(filename, **cls.FFMPEG_OPTIONS),
-                   data=info)
+    @classmethod
+    async def _prepare_progressive(cls,
+                                   track: 'ResolvedTrack',
+                                   path: str,
+                                   download: asyncio.Future) -> 'PreparedAudio':
+        """Waits for PROGRESSIVE_BUFFER bytes of the download to be on disk.
+
+        Returns None if the download finishes first, the whole file is then
+        played like any other download.
+        """
+        started = time.perf_counter()
+        part = path + '.part'
+        while not download.done():
+            try:
+                size = os.path.getsize(part)
+            except OSError:
+                size = 0
+            if size >= PROGRESSIVE_BUFFER:
+                logger.info(f'Playing "{track.title}" progressively, {size / 1024:.0f} KB buffered after {time.perf_counter() - started:.2f}s')
+                # Pinned before it is indexed, so eviction can't delete it under a seek or replay
+                download_cache.pin(track.key)
+                return PreparedAudio(track, path, cache_key=track.key, mode='progressive', download=download)
+            await asyncio.wait({download}, timeout=GrowingFile.POLL)
+        return None
+
+    @classmethod
+    async def _prepare_stream(cls,
+                              track: 'ResolvedTrack',
+                              *,
+                              loop: asyncio.BaseEventLoop) -> 'PreparedAudio':
+        if cls._stream_url_expired(track.stream_url):
+            logger.info(f'Stream URL for "{track.title}" expired, resolving again')
+            info = await resolve_flights.do(
+                track.url,
+                lambda: player_clients.run(track.channel.guild.id,
+                                           _extract_job,
+                                           track.url,
+                                           timeout=EXTRACT_TIMEOUT))
+            if info is None or not info.get('url'):
+                raise YTDLError('No stream URL for `{}`'.format(track.title))
+            track.stream_url = info['url']
+            track.http_headers = info.get('http_headers')
+            track.acodec = info.get('acodec')
+
+        before_options = cls.FFMPEG_STREAM_OPTIONS['before_options']
+        if track.http_headers:
+            headers = ''.join('{}: {}\r\n'.format(k, v) for k, v in track.http_headers.items())
+            before_options += ' -headers ' + shlex.quote(headers)
+
+        return PreparedAudio(track,
+                             track.stream_url,
+                             codec=track.acodec,
+                             mode='stream',
+                             before_options=before_options)
+
+    @classmethod
+    def _open(cls,
+              track: 'ResolvedTrack',
+              location: str,
+              *,
+              codec: str,
+              volume: float,
+              cache_key: str = None,
+              mode: str = 'download',
+              before_options: str = None,
+              start: float = 0.0,
+              pipe: bool = False):
+        if start > 0:
+            # Input-side seek, FFmpeg jumps to the position instead of decoding up to it
+            before_options = ' '.join(filter(None, ('-ss {:.3f}'.format(start), before_options)))
+
+        if OPUS_PASSTHROUGH and codec == 'opus' and not pipe:
+            logger.info(f'Using Opus passthrough for "{track.title}"')
+            return YTDLOpusSource(track,
+                                  location,
+                                  volume=volume,
+                                  cache_key=cache_key,
+                                  mode=mode,
+                                  before_options=before_options,
+                                  start=start)
+
+        audio_class = GrowingFileAudio if pipe else discord.FFmpegPCMAudio
+        return cls(track,
+                   audio_class(location,
+                               pipe=pipe,
+                               before_options=before_options,
+                               **cls.FFMPEG_OPTIONS),
+                   volume=volume,
+                   cache_key=cache_key,
+                   mode=mode,
+                   start=start)
+
+    @staticmethod
+    async def _probe_codec(filename: str):
+        if not OPUS_PASSTHROUGH:
+            return None
+        try:
+            codec, _ = await discord.FFmpegOpusAudio.probe(filename)
+        except Exception as e:
+            logger.debug(f'Could not probe codec of {filename}: {e}')
+            return None
+        return codec
+
+    @classmethod
+    def _stream_url_expired(cls, url: str) -> bool:
+        if not url:
+            return True
+        expire = urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get('expire')
+        if not expire:
+            return False
+        try:
+            return int(expire[0]) - time.time() < cls.STREAM_URL_MARGIN
+        except ValueError:
+            return False
+
+    @classmethod
+    async def _download_and_index(cls,
+                                  track: 'ResolvedTrack',
+                                  cache_key: str,
+                                  priority: int,
+                                  path: str = None) -> str:
+        loop = asyncio.get_running_loop()
+        await download_scheduler.acquire(cache_key, priority)
+        started = time.perf_counter()
+        try:
+            filename = await player_clients.run(track.channel.guild.id,
+                                                _download_job,
+                                                track.url,
+                                                download_scheduler.params(),
+                                                path,
+                                                timeout=DOWNLOAD_TIMEOUT,
+                                                lane=ExtractionPool.DOWNLOAD)
+        finally:
+            download_scheduler.release()
+        seconds = time.perf_counter() - started
+
+        size = await loop.run_in_executor(None, os.path.getsize, filename)
+        download_scheduler.record(track.title, size, seconds)
+        await loop.run_in_executor(None, download_cache.add, cache_key, filename)
+        return filename
 
     @staticmethod
     def parse_duration(duration: int):
@@ -211,40 +1859,669 @@ class YTDLSource(discord.PCMVolumeTransformer):
 
         return ', '.join(duration)
 
+    @staticmethod
+    def parse_timestamp(timestamp: str) -> int:
+        """Seconds in a timestamp like 90, 1:30 or 1:01:30."""
+        seconds = 0
+        for part in timestamp.strip().split(':'):
+            if not part.isdigit():
+                raise ValueError('Invalid timestamp `{}`'.format(timestamp))
+            seconds = seconds * 60 + int(part)
+        return seconds
+
+    @staticmethod
+    def format_timestamp(seconds: float) -> str:
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        if hours:
+            return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+        return '{}:{:02}'.format(minutes, seconds)
+
+
+class YTDLOpusSource(TrackSource, discord.FFmpegOpusAudio):
+    """Plays Opus audio without decoding it to PCM in the bot.
+
+    Volume is applied by an FFmpeg filter when the song is opened, so changes
+    only take effect on the next song. At 100% the Opus packets are copied
+    without any transcoding at all.
+    """
+
+    def __init__(self,
+                 track: 'ResolvedTrack',
+                 location: str,
+                 *,
+                 volume: float = 1.0,
+                 cache_key: str = None,
+                 mode: str = 'download',
+                 before_options: str = None,
+                 start: float = 0.0):
+        self._init_track(track, cache_key, mode, start)
+        self._volume = volume
+
+        if volume == 1.0:
+            codec = 'opus'
+            options = '-vn'
+        else:
+            codec = None
+            options = '-vn -filter:a volume={:.2f}'.format(volume)
+
+        super().__init__(location,
+                         codec=codec,
+                         before_options=before_options,
+                         options=options)
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        # Baked into the FFmpeg filter, picked up by the next song
+        pass
+
+
+class PreparedAudio:
+    """Where a song's audio can be read from, once it has been downloaded or resolved.
+
+    Holds a pin on the cached file until released. No FFmpeg process exists
+    until open() is called for the song that is about to play.
+    """
+
+    __slots__ = ('track', 'location', 'codec', 'cache_key', 'mode', 'before_options', 'download')
+
+    def __init__(self,
+                 track: 'ResolvedTrack',
+                 location: str,
+                 *,
+                 codec: str = None,
+                 cache_key: str = None,
+                 mode: str = 'download',
+                 before_options: str = None,
+                 download: asyncio.Future = None):
+        self.track = track
+        self.location = location
+        self.codec = codec
+        self.cache_key = cache_key
+        self.mode = mode
+        self.before_options = before_options
+        # Progressive mode: the download still writing to location
+        self.download = download
+
+    def open(self, volume: float, start: float = 0.0) -> TrackSource:
+        """Starts FFmpeg on the audio, start seconds in.
+
+        The source gets a pin of its own on the cached file.
+        """
+        if self.mode == 'stream':
+            logger.info(f'Streaming "{self.track.title}" without downloading')
+        if self.mode == 'progressive' and self.download.done() and not self.download.cancelled() \
+                and not self.download.exception():
+            # Finished while waiting its turn, play the file like any other download
+            self.location = self.download.result()
+            self.mode = 'download'
+            self.download = None
+        if self.cache_key:
+            download_cache.pin(self.cache_key)
+
+        growing = GrowingFile(self.location, self.download) if self.mode == 'progressive' else None
+        try:
+            source = YTDLSource._open(self.track,
+                                      growing or self.location,
+                                      codec=self.codec,
+                                      volume=volume,
+                                      cache_key=self.cache_key,
+                                      mode=self.mode,
+                                      before_options=self.before_options,
+                                      start=start,
+                                      pipe=growing is not None)
+        except Exception:
+            if self.cache_key:
+                download_cache.unpin(self.cache_key)
+            raise
+        source.download = self.download
+        source.growing = growing
+        return source
+
+    def release(self):
+        if self.cache_key:
+            download_cache.unpin(self.cache_key)
+            self.cache_key = None
+
+
+class ResolvedTrack:
+    """Compact record of a queued song, only what the embeds and /queue show.
+
+    The full yt-dlp info dict is never kept here, the song is extracted again
+    from its URL when it gets downloaded.
+    """
+
+    __slots__ = ('requester', 'channel', 'key', 'title', 'uploader', 'uploader_url',
+                 'thumbnail', 'seconds', 'url', 'stream_url', 'http_headers', 'acodec')
+
+    def __init__(self, ctx: commands.Context, data: dict):
+        self.requester = ctx.author
+        self.channel = ctx.channel
+        self.key = DownloadCache.make_key(data)
+
+        self.title = data.get('title')
+        self.uploader = data.get('uploader')
+        self.uploader_url = data.get('uploader_url')
+        self.thumbnail = data.get('thumbnail')
+        # Flat playlist entries sometimes come without a duration
+        self.seconds = int(data.get('duration') or 0)
+        self.url = data.get('webpage_url')
+        self.stream_url = data.get('url')
+        self.http_headers = data.get('http_headers')
+        self.acodec = data.get('acodec')
+
+    @property
+    def duration(self):
+        return YTDLSource.parse_duration(self.seconds) if self.seconds else 'Unknown'
+
+    def to_record(self) -> dict:
+        """The fields needed to queue this song again after a restart."""
+        return {
+            'key': self.key,
+            'title': self.title,
+            'uploader': self.uploader,
+            'uploader_url': self.uploader_url,
+            'thumbnail': self.thumbnail,
+            'seconds': self.seconds,
+            'url': self.url,
+            'requester': self.requester.id,
+            'channel': self.channel.id,
+        }
+
+    @classmethod
+    def from_record(cls, record: dict, requester, channel) -> 'ResolvedTrack':
+        track = cls.__new__(cls)
+        track.requester = requester
+        track.channel = channel
+        track.key = record['key']
+        track.title = record['title']
+        track.uploader = record.get('uploader')
+        track.uploader_url = record.get('uploader_url')
+        track.thumbnail = record.get('thumbnail')
+        track.seconds = record.get('seconds', 0)
+        track.url = record['url']
+        track.stream_url = None
+        track.http_headers = None
+        track.acodec = None
+        return track
+
+    def memory_size(self) -> int:
+        """Bytes held by this record, not counting the shared requester and channel."""
+        seen = set()
+        return sys.getsizeof(self) + sum(deep_sizeof(getattr(self, name), seen)
+                                         for name in self.__slots__
+                                         if name not in ('requester', 'channel'))
+
+    def __str__(self):
+        return '**{0.title}** by **{0.uploader}**'.format(self)
+
 
 class Song:
-    __slots__ = ('source', 'requester')
+    __slots__ = ('id', 'track', 'audio', 'source', 'requester', 'mode', '_fetch', '_released')
+
+    def __init__(self, track: ResolvedTrack, *, mode: str = None):
+        # Assigned by the SongQueue it gets added to
+        self.id = None
+        self.track = track
+        self.audio = None
+        self.source = None
+        self.requester = track.requester
+        self.mode = mode
+        self._fetch = None
+        self._released = False
+
+    def start_fetch(self,
+                    loop: asyncio.AbstractEventLoop,
+                    mode: str = None,
+                    priority: int = DownloadScheduler.PREFETCH):
+        """Starts downloading the audio in the background if not already started.
+
+        A mode given to the constructor wins over the mode passed here.
+        """
+        if self._fetch is None:
+            logger.info(f'Fetching audio for: {self.track.title}')
+            self._fetch = loop.create_task(
+                YTDLSource.prepare(self.track, loop=loop, mode=self.mode or mode, priority=priority))
+            self._fetch.add_done_callback(self._on_fetched)
+        elif priority == DownloadScheduler.NEXT:
+            # Started as a prefetch, now up next
+            download_scheduler.promote(self.track.key)
+        return self._fetch
+
+    async def fetch(self, loop: asyncio.AbstractEventLoop, mode: str = None) -> PreparedAudio:
+        """Waits for the audio of this song to be ready to open."""
+        self.audio = await asyncio.shield(self.start_fetch(loop, mode, DownloadScheduler.NEXT))
+        return self.audio
+
+    def open(self, volume: float, start: float = 0.0) -> TrackSource:
+        """Starts the FFmpeg process for this song, right before it plays."""
+        self.source = self.audio.open(volume, start)
+        return self.source
+
+    def _on_fetched(self, task: asyncio.Task):
+        if task.cancelled():
+            return
+        if task.exception():
+            logger.error(f'Fetching "{self.track.title}" failed: {task.exception()}')
+            return
+
+        self.audio = task.result()
+        if self._released:
+            self.audio.release()
+
+    def cancel_fetch(self):
+        """Stops waiting on an unfinished fetch, it can be started again later.
 
-    def __init__(self, source: YTDLSource):
-        self.source = source
-        self.requester = source.requester
+        Its download is dropped too if nothing else waits for it and it
+        hasn't started yet. One already running on a worker finishes.
+        """
+        if self._fetch is not None and not self._fetch.done():
+            logger.debug(f'Cancelling fetch for: {self.track.title}')
+            self._fetch.cancel()
+            self._fetch = None
+
+    def release(self):
+        """Drops this song's audio and its holds on the cached file."""
+        self._released = True
+        self.cancel_fetch()
+        if self.source:
+            self.source.cleanup()
+        if self.audio:
+            self.audio.release()
 
     def create_embed(self):
         embed = (discord.Embed(
             title='Now playing',
-            description='```css\n{0.source.title}\n```'.format(self),
+            description='```css\n{0.track.title}\n```'.format(self),
             color=discord.Color.blurple()).add_field(
-                name='Duration', value=self.source.duration).add_field(
+                name='Duration', value=self.track.duration).add_field(
                     name='Requested by',
-                    value=self.requester.mention).add_field(
+                    value='<@{}>'.format(self.requester.id)).add_field(
                         name='Uploader',
-                        value='[{0.source.uploader}]({0.source.uploader_url})'.
+                        value='[{0.track.uploader}]({0.track.uploader_url})'.
                         format(self)).add_field(
                             name='URL',
-                            value='[Click]({0.source.url})'.format(self)).
-                 set_thumbnail(url=self.source.thumbnail))
+                            value='[Click]({0.track.url})'.format(self)).
+                 set_thumbnail(url=self.track.thumbnail))
 
         return embed
 
 
+class Prefetcher:
+    """Downloads the next few songs of a guild's queue while the current one plays."""
+
+    def __init__(self, voice_state: 'VoiceState', depth: int):
+        self.voice_state = voice_state
+        self.depth = depth
+        self.started = set()
+        self.gaps = collections.deque(maxlen=50)
+
+    def refresh(self):
+        """Fetches the songs within depth of the head and cancels ones that fell out."""
+        window = self.voice_state.songs[:self.depth]
+
+        for song in self.started.difference(window):
+            if song is not self.voice_state.current:
+                song.cancel_fetch()
+
+        self.started = set(window)
+        for index, song in enumerate(window):
+            # The head of the queue plays next, its download goes before other prefetches
+            priority = DownloadScheduler.NEXT if index == 0 else DownloadScheduler.PREFETCH
+            song.start_fetch(self.voice_state.bot.loop, self.voice_state.playback_mode, priority)
+
+    def record_gap(self, gap: float):
+        self.gaps.append(gap)
+        average = sum(self.gaps) / len(self.gaps)
+        guild = self.voice_state.guild.name
+        if gap > TRACK_GAP_TARGET:
+            logger.warning(f'Gap between tracks was {gap * 1000:.0f} ms in guild {guild} (avg {average * 1000:.0f} ms)')
+        else:
+            logger.info(f'Gap between tracks was {gap * 1000:.0f} ms in guild {guild} (avg {average * 1000:.0f} ms)')
+
+
+class TrackNode:
+    __slots__ = ('song', 'prev', 'next')
+
+    def __init__(self, song: 'Song'):
+        self.song = song
+        self.prev = None
+        self.next = None
+
+
+class TrackList:
+    """Doubly linked list of songs indexed by song id and by requester.
+
+    Removing or moving a song by id is O(1), and so is counting a
+    requester's songs. Only positional access has to walk the list, from
+    whichever end is closer.
+    """
+
+    def __init__(self):
+        self.head = None
+        self.tail = None
+        self.nodes = {}
+        self.by_requester = collections.defaultdict(dict)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        node = self.head
+        while node:
+            yield node.song
+            node = node.next
+
+    def __contains__(self, song_id: int):
+        return song_id in self.nodes
+
+    def get(self, song_id: int) -> 'Song':
+        return self.nodes[song_id].song
+
+    def count_for(self, requester_id: int) -> int:
+        return len(self.by_requester.get(requester_id, ()))
+
+    def songs_for(self, requester_id: int) -> list:
+        return [node.song for node in self.by_requester.get(requester_id, {}).values()]
+
+    def _link_after(self, node: TrackNode, prev: TrackNode):
+        node.prev = prev
+        node.next = prev.next if prev else self.head
+        if node.next:
+            node.next.prev = node
+        else:
+            self.tail = node
+        if prev:
+            prev.next = node
+        else:
+            self.head = node
+
+    def _unlink(self, node: TrackNode):
+        if node.prev:
+            node.prev.next = node.next
+        else:
+            self.head = node.next
+        if node.next:
+            node.next.prev = node.prev
+        else:
+            self.tail = node.prev
+        node.prev = node.next = None
+
+    def _node_at(self, index: int) -> TrackNode:
+        if index < 0:
+            index += len(self.nodes)
+        if not 0 <= index < len(self.nodes):
+            raise IndexError('queue index out of range')
+
+        if index <= len(self.nodes) // 2:
+            node = self.head
+            for _ in range(index):
+                node = node.next
+        else:
+            node = self.tail
+            for _ in range(len(self.nodes) - 1 - index):
+                node = node.prev
+        return node
+
+    def append(self, song: 'Song'):
+        node = TrackNode(song)
+        self._link_after(node, self.tail)
+        self.nodes[song.id] = node
+        self.by_requester[song.requester.id][song.id] = node
+
+    def popleft(self) -> 'Song':
+        return self.remove(self.head.song.id)
+
+    def remove(self, song_id: int) -> 'Song':
+        node = self.nodes.pop(song_id)
+        self._unlink(node)
+
+        requester_songs = self.by_requester[node.song.requester.id]
+        del requester_songs[song_id]
+        if not requester_songs:
+            del self.by_requester[node.song.requester.id]
+        return node.song
+
+    def move(self, song_id: int, index: int):
+        """Moves a song so it ends up at index, clamped to the ends of the list."""
+        node = self.nodes[song_id]
+        self._unlink(node)
+
+        # The list is one shorter while the node is out
+        size = len(self.nodes) - 1
+        index = max(0, min(index, size))
+        if index == 0:
+            prev = None
+        elif index <= size // 2:
+            prev = self.head
+            for _ in range(index - 1):
+                prev = prev.next
+        else:
+            prev = self.tail
+            for _ in range(size - index):
+                prev = prev.prev
+        self._link_after(node, prev)
+
+    def page(self, start: int, stop: int) -> list:
+        start = max(start, 0)
+        stop = min(stop, len(self.nodes))
+        if start >= stop:
+            return []
+
+        node = self._node_at(start)
+        songs = []
+        for _ in range(stop - start):
+            songs.append(node.song)
+            node = node.next
+        return songs
+
+    def at(self, index: int) -> 'Song':
+        return self._node_at(index).song
+
+    def clear(self):
+        self.head = self.tail = None
+        self.nodes.clear()
+        self.by_requester.clear()
+
+    def replace(self, songs: list):
+        self.clear()
+        for song in songs:
+            self.append(song)
+
+
+class FairTrackList:
+    """Play order that takes turns between requesters instead of strict FIFO.
+
+    Every requester has their own TrackList and the rotation gives each of
+    them `weight` songs per turn (1 unless set). Adding and popping songs
+    only touch one sub-queue, nothing is re-sorted. Iterating walks the
+    rotation, so it yields songs in the order they will play.
+    """
+
+    def __init__(self, weights: dict = None):
+        self.queues = {}
+        self.rotation = collections.deque()
+        self.turn_used = 0
+        self.owners = {}
+        self.weights = weights if weights is not None else {}
+
+    def __len__(self):
+        return len(self.owners)
+
+    def __iter__(self):
+        iterators = {rid: iter(self.queues[rid]) for rid in self.rotation}
+        rotation = collections.deque(self.rotation)
+        used = self.turn_used
+        while rotation:
+            rid = rotation[0]
+            song = next(iterators[rid], None)
+            if song is None:
+                rotation.popleft()
+                used = 0
+                continue
+
+            yield song
+            used += 1
+            if used >= self.weight(rid):
+                rotation.rotate(-1)
+                used = 0
+
+    def __contains__(self, song_id: int):
+        return song_id in self.owners
+
+    def weight(self, requester_id: int) -> int:
+        return max(1, self.weights.get(requester_id, 1))
+
+    def get(self, song_id: int) -> 'Song':
+        return self.queues[self.owners[song_id]].get(song_id)
+
+    def count_for(self, requester_id: int) -> int:
+        queue = self.queues.get(requester_id)
+        return len(queue) if queue else 0
+
+    def songs_for(self, requester_id: int) -> list:
+        queue = self.queues.get(requester_id)
+        return list(queue) if queue else []
+
+    def append(self, song: 'Song'):
+        rid = song.requester.id
+        queue = self.queues.get(rid)
+        if queue is None:
+            queue = self.queues[rid] = TrackList()
+            self.rotation.append(rid)
+        queue.append(song)
+        self.owners[song.id] = rid
+
+    def popleft(self) -> 'Song':
+        rid = self.rotation[0]
+        song = self.queues[rid].popleft()
+        del self.owners[song.id]
+        self.turn_used += 1
+
+        if not self.queues[rid]:
+            del self.queues[rid]
+            self.rotation.popleft()
+            self.turn_used = 0
+        elif self.turn_used >= self.weight(rid):
+            self.rotation.rotate(-1)
+            self.turn_used = 0
+        return song
+
+    def remove(self, song_id: int) -> 'Song':
+        rid = self.owners.pop(song_id)
+        song = self.queues[rid].remove(song_id)
+
+        if not self.queues[rid]:
+            del self.queues[rid]
+            if self.rotation[0] == rid:
+                self.turn_used = 0
+            self.rotation.remove(rid)
+        return song
+
+    def move(self, song_id: int, index: int):
+        """Moves a song as close to index in the play order as its requester's turns allow.
+
+        Turns stay the same, so the song can only take the spot of one of
+        its requester's other songs.
+        """
+        rid = self.owners[song_id]
+        # Play order positions of the requester's songs, whichever song fills them
+        slots = [position for position, song in enumerate(self) if self.owners[song.id] == rid]
+        self.queues[rid].move(song_id, sum(1 for position in slots[1:] if position <= index))
+
+    def page(self, start: int, stop: int) -> list:
+        return list(itertools.islice(self, max(start, 0), max(stop, 0)))
+
+    def at(self, index: int) -> 'Song':
+        if index < 0:
+            index += len(self)
+        for song in itertools.islice(self, index, None):
+            return song
+        raise IndexError('queue index out of range')
+
+    def clear(self):
+        self.queues.clear()
+        self.rotation.clear()
+        self.turn_used = 0
+        self.owners.clear()
+
+    def replace(self, songs: list):
+        self.clear()
+        for song in songs:
+            self.append(song)
+
+
+QUEUE_MODES = ('fifo', 'fair')
+
+
 class SongQueue(asyncio.Queue):
+    """The guild's queue, with stable per-song ids on top of asyncio.Queue.
+
+    get() keeps asyncio.Queue's wake-up behaviour, the storage underneath is
+    a TrackList (fifo mode) or FairTrackList (fair mode) instead of a deque.
+    """
+
+    def __init__(self, *, on_change=None, mode: str = 'fifo', journal=None):
+        super().__init__()
+        self.on_change = None
+        self.journal = None
+        self._ids = itertools.count(1)
+        self.mode = 'fifo'
+        self.weights = {}
+        self.set_mode(mode)
+        self.on_change = on_change
+        self.journal = journal
+
+    def set_mode(self, mode: str):
+        """Switches between fifo and fair order, keeping the current play order as the start."""
+        if mode == self.mode:
+            return
+        songs = list(self._queue)
+        self._queue = FairTrackList(self.weights) if mode == 'fair' else TrackList()
+        self._queue.replace(songs)
+        self.mode = mode
+        self._record('queue_mode', value=mode)
+        self._changed()
+
+    def set_weight(self, requester_id: int, weight: int):
+        """Sets how many songs requester_id gets per turn in fair mode."""
+        self.weights[requester_id] = weight
+        self._record('weight', user=requester_id, value=weight)
+
+    def _record(self, op: str, **fields):
+        if self.journal:
+            self.journal(op, **fields)
+
+    def _init(self, maxsize):
+        self._queue = TrackList()
+
+    def _changed(self):
+        if self.on_change:
+            self.on_change()
+
+    def _put(self, item):
+        item.id = next(self._ids)
+        self._queue.append(item)
+        self._record('add', song=dict(item.track.to_record(), id=item.id))
+        self._changed()
+
+    def _get(self):
+        item = self._queue.popleft()
+        self._record('remove', ids=[item.id])
+        return item
+
     def __getitem__(self, item):
         if isinstance(item, slice):
-            return list(
-                itertools.islice(self._queue, item.start, item.stop,
-                                 item.step))
+            if item.step not in (None, 1):
+                return list(itertools.islice(self._queue, item.start, item.stop, item.step))
+            start, stop, _ = item.indices(len(self._queue))
+            return self._queue.page(start, stop)
         else:
-            return self._queue[item]
+            return self._queue.at(item)
 
     def __iter__(self):
         return self._queue.__iter__()
@@ -252,34 +2529,446 @@ class SongQueue(asyncio.Queue):
     def __len__(self):
         return self.qsize()
 
+    def __contains__(self, song_id: int):
+        return song_id in self._queue
+
+    def get_song(self, song_id: int) -> 'Song':
+        return self._queue.get(song_id)
+
+    def count_for(self, requester_id: int) -> int:
+        return self._queue.count_for(requester_id)
+
     def clear(self):
+        for song in self._queue:
+            song.release()
         self._queue.clear()
+        self._record('clear')
+        self._changed()
 
     def shuffle(self):
-        random.shuffle(self._queue)
+        songs = list(self._queue)
+        random.shuffle(songs)
+        self._queue.replace(songs)
+        self._record('order', ids=[song.id for song in self._queue])
+        self._changed()
 
     def remove(self, index: int):
-        del self._queue[index]
+        self.remove_id(self._queue.at(index).id)
+
+    def remove_id(self, song_id: int) -> 'Song':
+        song = self._queue.remove(song_id)
+        song.release()
+        self._record('remove', ids=[song_id])
+        self._changed()
+        return song
+
+    def remove_requester(self, requester_id: int) -> int:
+        songs = self._queue.songs_for(requester_id)
+        for song in songs:
+            self._queue.remove(song.id)
+            song.release()
+        if songs:
+            self._record('remove', ids=[song.id for song in songs])
+            self._changed()
+        return len(songs)
+
+    def move(self, song_id: int, index: int):
+        self._queue.move(song_id, index)
+        if self.mode == 'fifo':
+            self._record('move', id=song_id, index=index)
+        else:
+            # Fair mode moves within one requester's songs, log the resulting order
+            self._record('order', ids=[song.id for song in self._queue])
+        self._changed()
+
+    def dedupe(self) -> int:
+        """Removes later copies of songs that are already queued."""
+        seen = set()
+        duplicates = []
+        for song in self._queue:
+            if song.track.key in seen:
+                duplicates.append(song)
+            seen.add(song.track.key)
+
+        for song in duplicates:
+            self._queue.remove(song.id)
+            song.release()
+        if duplicates:
+            self._record('remove', ids=[song.id for song in duplicates])
+            self._changed()
+        return len(duplicates)
+
+
+class StateJournal:
+    """Append-only log of queue and player changes, replayed on startup.
+
+    Records are buffered in memory and appended by a background task on the
+    default executor, so recording never blocks the event loop. Every
+    STATE_COMPACT_INTERVAL the log is rewritten as a snapshot of the live
+    state.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pending = []
+        self.enabled = True
+        # Saved guilds that could not be restored, kept until the next startup
+        self.carried_over = {}
+        self.written = 0
+        self.compactions = 0
+        self._task = None
+
+    def record(self, guild_id: int, op: str, **fields):
+        if self.enabled:
+            fields['g'] = guild_id
+            fields['op'] = op
+            self.pending.append(fields)
+
+    @staticmethod
+    def records_for(guild_id: int, *, voice, volume, queue_mode, playback_mode, weights, current, position,
+                    queue) -> list:
+        records = [
+            {'g': guild_id, 'op': 'voice', 'value': voice},
+            {'g': guild_id, 'op': 'volume', 'value': volume},
+            {'g': guild_id, 'op': 'queue_mode', 'value': queue_mode},
+            {'g': guild_id, 'op': 'playback_mode', 'value': playback_mode},
+            {'g': guild_id, 'op': 'current', 'song': current, 'position': position},
+        ]
+        records.extend({'g': guild_id, 'op': 'weight', 'user': user_id, 'value': weight}
+                       for user_id, weight in weights.items())
+        records.extend({'g': guild_id, 'op': 'add', 'song': song} for song in queue)
+        return records
+
+    def load(self) -> dict:
+        """Replays the log in one streaming pass, returns guild id -> saved state."""
+        guilds = {}
+        try:
+            f = open(self.path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return guilds
+
+        with f:
+            for number, line in enumerate(f, 1):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Most likely a write cut short by a crash
+                    logger.warning(f'Skipping unreadable line {number} of {self.path}')
+                    continue
+                self._apply(guilds, entry)
+        return guilds
+
+    @staticmethod
+    def _apply(guilds: dict, entry: dict):
+        state = guilds.get(entry['g'])
+        if state is None:
+            state = guilds[entry['g']] = {
+                'voice': None, 'volume': 1.0, 'queue_mode': None, 'playback_mode': None,
+                'weights': {}, 'current': None, 'position': 0, 'queue': {},
+            }
+
+        op = entry['op']
+        queue = state['queue']
+        if op == 'add':
+            queue[entry['song']['id']] = entry['song']
+        elif op == 'remove':
+            for song_id in entry['ids']:
+                queue.pop(song_id, None)
+        elif op == 'clear':
+            queue.clear()
+        elif op == 'order':
+            state['queue'] = {song_id: queue[song_id] for song_id in entry['ids'] if song_id in queue}
+        elif op == 'move':
+            ids = list(queue)
+            if entry['id'] in queue:
+                ids.remove(entry['id'])
+                ids.insert(max(0, entry['index']), entry['id'])
+                state['queue'] = {song_id: queue[song_id] for song_id in ids}
+        elif op == 'current':
+            state['current'] = entry['song']
+            state['position'] = entry.get('position', 0)
+        elif op == 'position':
+            state['position'] = entry['value']
+        elif op == 'weight':
+            state['weights'][entry['user']] = entry['value']
+        elif op in ('voice', 'volume', 'queue_mode', 'playback_mode'):
+            state[op] = entry['value']
+
+    def start(self, voice_states: dict):
+        self._task = asyncio.get_running_loop().create_task(self._run(voice_states))
+
+    async def _run(self, voice_states: dict):
+        last_position = last_compact = time.monotonic()
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            try:
+                now = time.monotonic()
+                if now - last_compact >= STATE_COMPACT_INTERVAL:
+                    last_compact = last_position = now
+                    await self.compact(voice_states)
+                    continue
+
+                if now - last_position >= STATE_POSITION_INTERVAL:
+                    last_position = now
+                    for guild_id, state in voice_states.items():
+                        song, position = state.resume_point()
+                        if song:
+                            self.record(guild_id, 'position', value=position)
+
+                await self.flush()
+            except Exception as e:
+                logger.error(f'Writing state journal failed: {e}')
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        if batch:
+            await asyncio.get_running_loop().run_in_executor(None, self._append, batch)
+
+    async def compact(self, voice_states: dict):
+        """Replaces the log with a snapshot of the live state."""
+        # Taken without yielding to the loop, so no change falls between the two
+        records = self.snapshot(voice_states)
+        self.pending = []
+        await asyncio.get_running_loop().run_in_executor(None, self._rewrite, records)
+
+    def snapshot(self, voice_states: dict) -> list:
+        records = []
+        for state in voice_states.values():
+            records.extend(state.snapshot())
+        for guild_id, saved in self.carried_over.items():
+            if guild_id not in voice_states:
+                records.extend(self.records_for(guild_id,
+                                                voice=saved['voice'],
+                                                volume=saved['volume'],
+                                                queue_mode=saved['queue_mode'],
+                                                playback_mode=saved['playback_mode'],
+                                                weights=saved['weights'],
+                                                current=saved['current'],
+                                                position=saved['position'],
+                                                queue=list(saved['queue'].values())))
+        return records
+
+    def _append(self, records: list):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        self.written += len(records)
+
+    def _rewrite(self, records: list):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        os.replace(tmp_path, self.path)
+        self.compactions += 1
+        logger.info(f'Compacted state journal to {len(records)} records')
+
+    def close(self, voice_states: dict):
+        """Stops recording and writes a final snapshot, used on shutdown."""
+        self.enabled = False
+        if self._task:
+            self._task.cancel()
+            self._task = None
+            self._rewrite(self.snapshot(voice_states))
+
+
+state_journal = StateJournal(STATE_JOURNAL_PATH)
+
+
+class ListenerCounts:
+    """Number of people (not bots) in each voice channel, kept current from voice state events.
+
+    A channel is counted from the member cache the first time it is asked
+    about, after that only on_voice_state_update changes its count.
+    """
+
+    def __init__(self):
+        self.counts = {}
+
+    def get(self, channel: discord.VoiceChannel) -> int:
+        count = self.counts.get(channel.id)
+        if count is None:
+            count = self.counts[channel.id] = sum(not member.bot for member in channel.members)
+        return count
+
+    def update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+        if member.bot or before.channel == after.channel:
+            return
+        if before.channel and before.channel.id in self.counts:
+            self.counts[before.channel.id] = max(0, self.counts[before.channel.id] - 1)
+        if after.channel and after.channel.id in self.counts:
+            self.counts[after.channel.id] += 1
+
+
+listener_counts = ListenerCounts()
+
+
+class VoiceLog:
+    """Buffers voice activity lines per guild and posts them to #logs in batches.
+
+    The logs channel is looked up once per guild and cached until a channel
+    in that guild is created, renamed or deleted. Guilds without one are
+    skipped.
+    """
+
+    CHANNEL_NAME = 'logs'
+    # Discord's message length limit
+    MESSAGE_LIMIT = 2000
+
+    def __init__(self):
+        self.channels = {}
+        self.pending = {}
+        # The guild of each pending batch, its channel is looked up again at flush
+        self.guilds = {}
+        self.wakeup = asyncio.Event()
+        self.sent_lines = 0
+        self.sent_messages = 0
+        self.dropped_full = 0
+        self.dropped_no_channel = 0
+        self.dropped_failed = 0
+        self.failed = 0
+        self._task = None
+
+    def channel_for(self, guild: discord.Guild):
+        if guild.id not in self.channels:
+            self.channels[guild.id] = discord.utils.get(guild.text_channels, name=self.CHANNEL_NAME)
+        return self.channels[guild.id]
+
+    def invalidate(self, guild_id: int):
+        self.channels.pop(guild_id, None)
+
+    def add(self, guild: discord.Guild, line: str):
+        if self.channel_for(guild) is None:
+            self.dropped_no_channel += 1
+            return
+
+        self.guilds[guild.id] = guild
+        lines = self.pending.setdefault(guild.id, [])
+        if len(lines) >= VOICE_LOG_MAX_PENDING:
+            self.dropped_full += 1
+            return
+        lines.append(line)
+        if len(lines) >= VOICE_LOG_BATCH:
+            self.wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=VOICE_LOG_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        guilds, self.guilds = self.guilds, {}
+        # One guild at a time, so a burst never turns into a burst of requests
+        for guild_id, lines in pending.items():
+            # Invalidated since the lines were added if the guild's channels changed
+            channel = self.channel_for(guilds[guild_id])
+            if channel is None:
+                self.dropped_no_channel += len(lines)
+                continue
+            unsent = len(lines)
+            for message, count in self._batches(lines):
+                try:
+                    await channel.send(message)
+                except discord.HTTPException as e:
+                    logger.warning(f'Could not post voice log in guild {channel.guild.name}: {e}')
+                    self.failed += 1
+                    # The rest of this guild's lines are dropped with it
+                    self.dropped_failed += unsent
+                    break
+                self.sent_messages += 1
+                self.sent_lines += count
+                unsent -= count
+
+    def _batches(self, lines: list):
+        """Yields messages under the length limit and how many lines each holds."""
+        message = ''
+        count = 0
+        for line in lines:
+            line = line[:self.MESSAGE_LIMIT]
+            if message and len(message) + len(line) + 1 > self.MESSAGE_LIMIT:
+                yield message, count
+                message = ''
+                count = 0
+            message = message + '\n' + line if message else line
+            count += 1
+        if message:
+            yield message, count
+
+    def stats(self) -> dict:
+        return {
+            'pending': sum(len(lines) for lines in self.pending.values()),
+            'sent_lines': self.sent_lines,
+            'sent_messages': self.sent_messages,
+            'dropped_full': self.dropped_full,
+            'dropped_no_channel': self.dropped_no_channel,
+            'dropped_failed': self.dropped_failed,
+            'failed': self.failed,
+        }
+
+
+voice_log = VoiceLog()
 
 
 class VoiceState(discord.VoiceState):
-    def __init__(self, bot: commands.Bot, ctx: commands.Context):
+    def __init__(self, bot: commands.Bot, guild: discord.Guild, connect):
         self.bot = bot
-        self._ctx = ctx
+        self.guild = guild
+        # Coroutine function that joins a voice channel, used to reconnect
+        self.connect = connect
 
         self.current = None
-        self.voice = None
+        self._voice = None
         self.next = asyncio.Event()
-        self.songs = SongQueue()
+        self.prefetcher = Prefetcher(self, FETCH_AHEAD)
+        self.songs = SongQueue(on_change=self.prefetcher.refresh,
+                               mode=QUEUE_MODE,
+                               journal=self._record)
+        self._song_ended_at = None
 
         self._loop = False
-        self._volume = 0.5
+        # Full volume, anything else makes Opus songs go through an FFmpeg volume filter
+        self._volume = 1.0
+        self._playback_mode = PLAYBACK_MODE
+        self._replay = None
+        self._replay_start = 0.0
+        # Where the current song starts, until its source is open
+        self._current_start = 0.0
+        self.playlist_loads = set()
         self.skip_votes = set()
+        # Set while paused because nobody is listening, with the task that leaves after the grace period
+        self.auto_paused = False
+        self.empty_leave = None
+
+        # Seconds each automatic reconnect took
+        self.reconnects = collections.deque(maxlen=20)
+        # When the reaper first saw this guild idle
+        self.idle_since = None
+
+        # Not started for the throwaway states of commands that don't play audio
+        self.audio_player = None
+        self.supervisor = None
 
-        self.audio_player = bot.loop.create_task(self.audio_player_task())
+    def start(self):
+        """Starts the player loop and voice supervisor, once the state is registered."""
+        self.audio_player = self.bot.loop.create_task(self.audio_player_task())
+        self.supervisor = self.bot.loop.create_task(self.supervisor_task())
+        return self
+
+    @property
+    def started(self) -> bool:
+        return self.audio_player is not None
 
     def __del__(self):
-        self.audio_player.cancel()
+        if self.started:
+            self.audio_player.cancel()
+            self.supervisor.cancel()
 
     @property
     def loop(self):
@@ -296,11 +2985,77 @@ class VoiceState(discord.VoiceState):
     @volume.setter
     def volume(self, value: float):
         self._volume = value
+        self._record('volume', value=value)
+
+    @property
+    def voice(self):
+        return self._voice
+
+    @voice.setter
+    def voice(self, value: discord.VoiceClient):
+        self._voice = value
+        self._record('voice', value=value.channel.id if value else None)
+
+    @property
+    def playback_mode(self):
+        return self._playback_mode
+
+    @playback_mode.setter
+    def playback_mode(self, value: str):
+        self._playback_mode = value
+        self._record('playback_mode', value=value)
+
+    @property
+    def position(self) -> float:
+        """How many seconds into the current song playback is."""
+        if self.current is None:
+            return 0.0
+        if self.current.source is None:
+            return self._current_start
+        return self.current.source.position
 
     @property
     def is_playing(self):
         return self.voice and self.current
 
+    def _record(self, op: str, **fields):
+        if self.started:
+            state_journal.record(self.guild.id, op, **fields)
+
+    def resume_point(self) -> tuple:
+        """The song playback goes on with after a restart and where in it, a lined up replay comes first."""
+        if self._replay is not None:
+            return self._replay, self._replay_start
+        return self.current, self.position
+
+    def snapshot(self) -> list:
+        """Journal records that rebuild this guild's current state."""
+        song, position = self.resume_point()
+        return StateJournal.records_for(
+            self.guild.id,
+            voice=self.voice.channel.id if self.voice else None,
+            volume=self._volume,
+            queue_mode=self.songs.mode,
+            playback_mode=self._playback_mode,
+            weights=self.songs.weights,
+            current=song.track.to_record() if song else None,
+            position=position,
+            queue=[dict(song.track.to_record(), id=song.id) for song in self.songs])
+
+    def replay(self, song: 'Song', start: float = 0.0):
+        """Plays song from start seconds before anything in the queue.
+
+        Used to pick interrupted songs back up where they stopped.
+        """
+        self._replay = song
+        self._replay_start = start
+        self._record('current', song=song.track.to_record(), position=start)
+
+    def seek(self, position: float):
+        """Restarts the current song position seconds in."""
+        self.replay(Song(self.current.track, mode=self.current.source.mode), position)
+        self.voice.stop()
+
     def is_voice_connected(self) -> bool:
         """Check if the voice connection is healthy."""
         if not self.voice:
@@ -310,71 +3065,229 @@ class VoiceState(discord.VoiceState):
         return True
 
     async def audio_player_task(self):
-        logger.info(f'Audio player task started for guild {self._ctx.guild.name}')
+        logger.info(f'Audio player task started for guild {self.guild.name}')
         while True:
             self.next.clear()
-            logger.debug(f'Audio player loop iteration for guild {self._ctx.guild.name}')
+            logger.debug(f'Audio player loop iteration for guild {self.guild.name}')
+            start = 0.0
 
-            if not self.loop:
-                # Try to get the next song within a day.
-                # If no song will be added to the queue in time,
-                # the player will disconnect due to performance
-                # reasons.
-                try:
-                    logger.info(f'Waiting for next song in queue for guild {self._ctx.guild.name}')
-                    async with timeout(129600):  # 1 day
-                        self.current = await self.songs.get()
-                        logger.info(f'Got song from queue: {self.current.source.title}')
-
-                except asyncio.TimeoutError:
-                    logger.warning(f'Audio player timeout - no songs for 36 hours in guild {self._ctx.guild.name}')
-                    await self.stop()
-                    return
+            if self._replay is not None:
+                self.current, self._replay = self._replay, None
+                start, self._replay_start = self._replay_start, 0.0
+                logger.info(f'Replaying "{self.current.track.title}" from {start:.1f}s in guild {self.guild.name}')
+
+            elif not self.loop:
+                # Waits as long as it takes, the reaper disconnects idle guilds
+                if self.songs.empty():
+                    # Waiting on users is not a gap between tracks
+                    self._song_ended_at = None
+
+                logger.info(f'Waiting for next song in queue for guild {self.guild.name}')
+                self.current = await self.songs.get()
+                logger.info(f'Got song from queue: {self.current.track.title}')
+
+            # Recorded before the download, the queue no longer has it
+            self._current_start = start
+            self._record('current', song=self.current.track.to_record(), position=start)
 
             # Check if we have a voice connection, if not try to get it from the guild
             if not self.voice or not self.is_voice_connected():
-                logger.warning(f'Voice connection stale or missing in guild {self._ctx.guild.name}, attempting to recover...')
-                self.voice = self._ctx.guild.voice_client
-
-                # If still no valid connection, we can't proceed
-                if not self.voice or not self.voice.is_connected():
-                    logger.error(f'No voice connection available in guild {self._ctx.guild.name}. User needs to use /come or /play to reconnect.')
-                    # Put the song back in the queue so it's not lost
+                logger.warning(f'Voice connection stale or missing in guild {self.guild.name}, attempting to recover...')
+                voice = self.guild.voice_client
+
+                # If still no valid connection, we can't proceed,
+                # the supervisor restarts the player once it has reconnected
+                if not voice or not voice.is_connected():
+                    logger.error(f'No voice connection available in guild {self.guild.name}, waiting for reconnect')
+                    # Keep the song so it picks up where it was once the player runs again
                     if self.current:
-                        logger.info(f'Song "{self.current.source.title}" will need to be re-queued after reconnection')
+                        logger.info(f'Song "{self.current.track.title}" will resume at {start:.1f}s after reconnection')
+                        self.replay(self.current, start)
                     return
                 else:
-                    logger.info(f'Retrieved voice connection from guild {self._ctx.guild.name}')
+                    self.voice = voice
+                    logger.info(f'Retrieved voice connection from guild {self.guild.name}')
+
+            # Keep the songs right behind this one downloading while it plays
+            self.current.start_fetch(self.bot.loop, self.playback_mode, DownloadScheduler.NEXT)
+            self.prefetcher.refresh()
 
-            self.current.source.volume = self._volume
-            logger.info(f'Playing: {self.current.source.title} in guild {self._ctx.guild.name}')
+            try:
+                await self.current.fetch(self.bot.loop, self.playback_mode)
+                self.current.open(self._volume, start)
+            except Exception as e:
+                logger.error(f'Could not load "{self.current.track.title}" in guild {self.guild.name}: {e}')
+                await self.current.track.channel.send(
+                    'Could not play {}: {}'.format(str(self.current.track), e))
+                self.current.release()
+                self.current = None
+                self._record('current', song=None)
+                continue
+
+            logger.info(f'Playing: {self.current.track.title} in guild {self.guild.name}')
             self.voice.play(self.current.source, after=self.play_next_song)
-            await self.current.source.channel.send(
+            if self._song_ended_at is not None:
+                self.prefetcher.record_gap(time.perf_counter() - self._song_ended_at)
+                self._song_ended_at = None
+            await self.current.track.channel.send(
                 embed=self.current.create_embed())
 
             await self.next.wait()
-            logger.debug(f'Song finished playing in guild {self._ctx.guild.name}')
+            logger.debug(f'Song finished playing in guild {self.guild.name}')
+
+            source = self.current.source
+            # `after` runs before the audio thread cleans up, FFmpeg's exit status isn't known yet
+            await source.wait_closed(self.bot.loop)
+            if self._replay is not None:
+                # Seeking, the replacement is already lined up
+                pass
+            elif source.mode in ('stream', 'progressive') and source.failed():
+                logger.warning(f'Playing "{self.current.track.title}" in {source.mode} mode failed in guild {self.guild.name} at {source.position:.1f}s, replaying in download mode')
+                self.replay(Song(self.current.track, mode='download'), source.position)
+            elif not self.is_voice_connected():
+                logger.warning(f'Voice dropped during "{self.current.track.title}" in guild {self.guild.name} at {source.position:.1f}s')
+                self.replay(Song(self.current.track, mode=source.mode), source.position)
+
+            self.current.release()
+            if self._replay is None:
+                self._record('current', song=None)
+
+    async def supervisor_task(self):
+        """Watches the voice connection, reconnecting and restarting the player when needed.
+
+        discord.py retries dropped connections by itself, so the connection
+        gets VOICE_RECONNECT_GRACE seconds to come back before the bot joins
+        the channel again.
+        """
+        down_since = None
+        while True:
+            await asyncio.sleep(VOICE_CHECK_INTERVAL)
+
+            # Not meant to be in a channel
+            if self.voice is None:
+                down_since = None
+                continue
+
+            if self.is_voice_connected():
+                down_since = None
+                if self.audio_player.done():
+                    self.restart_player()
+                continue
+
+            now = time.monotonic()
+            if down_since is None:
+                down_since = now
+                logger.warning(f'Voice connection down in guild {self.guild.name}')
+            if now - down_since >= VOICE_RECONNECT_GRACE:
+                await self.reconnect()
+                down_since = None
+
+    async def reconnect(self):
+        """Joins the last voice channel again, backing off until it works or the bot is told to leave."""
+        channel = self.voice.channel
+        delay = VOICE_CHECK_INTERVAL
+        started = time.perf_counter()
+
+        while self.voice is not None:
+            try:
+                voice = await self.connect(channel)
+            except VoiceError as e:
+                logger.error(f'Reconnecting to {channel.name} in guild {self.guild.name} failed, trying again in {delay:.0f}s: {e}')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, VOICE_RECONNECT_MAX_DELAY)
+                continue
+
+            if self.voice is None:
+                # Left while reconnecting
+                await voice.disconnect()
+                return
+
+            self.voice = voice
+            latency = time.perf_counter() - started
+            self.reconnects.append(latency)
+            logger.info(f'Reconnected to {channel.name} in guild {self.guild.name} after {latency:.2f} seconds')
+            if self.audio_player.done():
+                self.restart_player()
+            return
+
+    def restart_player(self):
+        """Starts the player loop again, it picks up any interrupted song and the queue."""
+        if not self.audio_player.cancelled() and self.audio_player.exception():
+            logger.error(f'Audio player in guild {self.guild.name} crashed: {self.audio_player.exception()}')
+        logger.info(f'Restarting audio player for guild {self.guild.name}')
+        self.audio_player = self.bot.loop.create_task(self.audio_player_task())
 
     def play_next_song(self, error=None):
+        # Runs on discord's audio thread, asyncio.Event.set() alone wouldn't wake the loop
+        self._song_ended_at = time.perf_counter()
+        self.bot.loop.call_soon_threadsafe(self.next.set)
         if error:
             raise VoiceError(str(error))
 
-        self.next.set()
-
     def skip(self):
         self.skip_votes.clear()
 
         if self.is_playing:
             self.voice.stop()
 
+    def cancel_playlist_loads(self):
+        for task in self.playlist_loads:
+            task.cancel()
+        self.playlist_loads.clear()
+
+    def idle_reason(self):
+        """Why this guild counts as idle, or None while it is in use."""
+        if self.voice is None:
+            return 'not connected'
+        if not self.voice.is_connected():
+            return 'voice connection lost'
+        if listener_counts.get(self.voice.channel) == 0:
+            return 'empty channel'
+        if self.voice.is_paused():
+            return 'paused'
+        if self.current is None and self._replay is None and self.songs.empty():
+            return 'nothing queued'
+        return None
+
+    def listeners_changed(self, count: int):
+        """Pauses while nobody is in the channel and resumes when someone is back.
+
+        Returns True if the channel just became empty, so the caller can
+        schedule leaving it.
+        """
+        if count == 0:
+            if self.voice.is_playing():
+                logger.info(f'Nobody listening in {self.voice.channel.name} in guild {self.guild.name}, pausing')
+                self.voice.pause()
+                self.auto_paused = True
+            return self.empty_leave is None
+
+        if self.empty_leave is not None:
+            self.empty_leave.cancel()
+            self.empty_leave = None
+        if self.auto_paused:
+            self.auto_paused = False
+            if self.voice.is_paused():
+                logger.info(f'Listener back in {self.voice.channel.name} in guild {self.guild.name}, resuming')
+                self.voice.resume()
+        return False
+
     async def stop(self):
-        logger.info(f'Stopping voice state for guild {self._ctx.guild.name}')
+        logger.info(f'Stopping voice state for guild {self.guild.name}')
+        if self.started:
+            self.supervisor.cancel()
+            self.audio_player.cancel()
+        self.cancel_playlist_loads()
         self.songs.clear()
+        for song in (self.current, self._replay):
+            if song:
+                song.release()
+        self.current = self._replay = None
         
         if self.voice:
-            logger.info(f'Disconnecting from voice channel {self.voice.channel.name}')
-            await self.voice.disconnect()
-            self.voice = None
+            voice, self.voice = self.voice, None
+            logger.info(f'Disconnecting from voice channel {voice.channel.name}')
+            await voice.disconnect()
             logger.info('Voice disconnection complete')
             
             
@@ -434,6 +3347,9 @@ class Music(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot: commands.Bot = bot
         self.voice_states = {}
+        self._restored = False
+        self.reaper = None
+        self.reaped = 0
 
     async def connect_with_retry(self, channel: discord.VoiceChannel, max_retries: int = 3, delay: float = 2.0) -> discord.VoiceClient:
         """Connect to a voice channel with retry logic for handling stale connections."""
@@ -482,15 +3398,156 @@ class Music(commands.Cog):
     def get_voice_state(self, ctx: commands.Context):
         state = self.voice_states.get(ctx.guild.id)
         if not state:
-            state = VoiceState(self.bot, ctx)
+            state = VoiceState(self.bot, ctx.guild, self.connect_with_retry).start()
             self.voice_states[ctx.guild.id] = state
 
         return state
 
+    def peek_voice_state(self, ctx: commands.Context):
+        """The guild's voice state, or an empty one that isn't kept if there is none yet."""
+        state = self.voice_states.get(ctx.guild.id)
+        if not state:
+            state = VoiceState(self.bot, ctx.guild, self.connect_with_retry)
+        return state
+
+    async def reaper_task(self):
+        """Disconnects guilds that stayed idle for IDLE_TIMEOUT and drops their voice state."""
+        while True:
+            await asyncio.sleep(REAPER_INTERVAL)
+            now = time.monotonic()
+            for guild_id, state in list(self.voice_states.items()):
+                if self.voice_states.get(guild_id) is not state:
+                    # Left while an earlier guild was being stopped
+                    continue
+                reason = state.idle_reason()
+                if reason is None:
+                    state.idle_since = None
+                    continue
+                if state.idle_since is None:
+                    state.idle_since = now
+                    continue
+                if now - state.idle_since < IDLE_TIMEOUT:
+                    continue
+
+                logger.info(f'Reaping idle guild {state.guild.name} ({reason})')
+                del self.voice_states[guild_id]
+                self.reaped += 1
+                try:
+                    await state.stop()
+                except Exception as e:
+                    logger.error(f'Error stopping idle guild {state.guild.name}: {e}')
+
     def cog_unload(self):
+        if self.reaper:
+            self.reaper.cancel()
+        # Save queues before stopping clears them, so a restart can pick them back up
+        state_journal.close(self.voice_states)
         for state in self.voice_states.values():
             self.bot.loop.create_task(state.stop())
 
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if self._restored:
+            return
+        self._restored = True
+        self.reaper = self.bot.loop.create_task(self.reaper_task())
+
+        started = time.perf_counter()
+        saved = await self.bot.loop.run_in_executor(None, state_journal.load)
+
+        # The restore itself would otherwise be journaled on top of the saved state
+        state_journal.enabled = False
+        try:
+            results = await asyncio.gather(*(self._restore_guild(guild_id, state)
+                                             for guild_id, state in saved.items()
+                                             if state['voice']),
+                                           return_exceptions=True)
+        finally:
+            state_journal.enabled = True
+
+        restored = sum(result is True for result in results)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f'Restoring a guild failed: {result}')
+
+        await state_journal.compact(self.voice_states)
+        state_journal.start(self.voice_states)
+        logger.info(f'Restored {restored}/{len(results)} guilds in {time.perf_counter() - started:.2f} seconds')
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+        listener_counts.update(member, before, after)
+
+        state = self.voice_states.get(member.guild.id)
+        if state is None or state.voice is None or state.voice.channel is None:
+            return
+
+        channel = state.voice.channel
+        if member.id == self.bot.user.id:
+            # The bot itself joined or moved, look at who is in the new channel
+            if after.channel is None or before.channel == after.channel:
+                return
+        elif channel not in (before.channel, after.channel):
+            return
+
+        if state.listeners_changed(listener_counts.get(channel)):
+            state.empty_leave = self.bot.loop.create_task(self._leave_empty(state))
+
+    async def _leave_empty(self, state: VoiceState):
+        await asyncio.sleep(EMPTY_CHANNEL_GRACE)
+        state.empty_leave = None
+        # Already gone through /leave, /fix or the reaper
+        if self.voice_states.get(state.guild.id) is not state:
+            return
+
+        logger.info(f'Leaving empty channel in guild {state.guild.name} after {EMPTY_CHANNEL_GRACE:.0f} seconds')
+        del self.voice_states[state.guild.id]
+        await state.stop()
+
+    async def _restore_guild(self, guild_id: int, saved: dict) -> bool:
+        guild = self.bot.get_guild(guild_id)
+        channel = guild.get_channel(saved['voice']) if guild else None
+        if channel is None:
+            logger.info(f'Not restoring guild {guild_id}, guild or voice channel is gone')
+            return False
+
+        def song_for(record: dict):
+            text_channel = guild.get_channel(record['channel']) or guild.system_channel
+            if text_channel is None:
+                return None
+            requester = guild.get_member(record['requester']) or discord.Object(id=record['requester'])
+            return Song(ResolvedTrack.from_record(record, requester, text_channel))
+
+        try:
+            voice = await self.connect_with_retry(channel)
+        except VoiceError as e:
+            logger.error(f'Could not rejoin {channel.name} in guild {guild.name}, keeping its queue for next startup: {e}')
+            state_journal.carried_over[guild_id] = saved
+            return False
+
+        state = VoiceState(self.bot, guild, self.connect_with_retry)
+        state.voice = voice
+        state.volume = saved['volume']
+        for user_id, weight in saved['weights'].items():
+            state.songs.set_weight(user_id, weight)
+        if saved['playback_mode'] in PLAYBACK_MODES:
+            state.playback_mode = saved['playback_mode']
+        if saved['queue_mode'] in QUEUE_MODES:
+            state.songs.set_mode(saved['queue_mode'])
+
+        if saved['current']:
+            song = song_for(saved['current'])
+            if song:
+                state.replay(song, saved['position'])
+        for record in saved['queue'].values():
+            song = song_for(record)
+            if song:
+                state.songs.put_nowait(song)
+
+        self.voice_states[guild_id] = state.start()
+        logger.info(f'Restored guild {guild.name}: {len(state.songs)} queued songs in {channel.name}')
+        return True
+
     def cog_check(self, ctx: commands.Context):
         if not ctx.guild:
             raise commands.NoPrivateMessage(
@@ -498,8 +3555,14 @@ class Music(commands.Cog):
 
         return True
 
+    # Commands that need a running player, the rest only look at the guild's state
+    AUDIO_COMMANDS = ('come', 'goto', 'play', 'mode', 'queuemode', 'fairweight')
+
     async def cog_before_invoke(self, ctx: commands.Context):
-        ctx.voice_state = self.get_voice_state(ctx)
+        if ctx.command.name in self.AUDIO_COMMANDS:
+            ctx.voice_state = self.get_voice_state(ctx)
+        else:
+            ctx.voice_state = self.peek_voice_state(ctx)
 
     async def cog_command_error(self, ctx: commands.Context,
                                 error: commands.CommandError):
@@ -574,7 +3637,8 @@ class Music(commands.Cog):
             return await ctx.send('Not connected to any voice channel.')
 
         await ctx.voice_state.stop()
-        del self.voice_states[ctx.guild.id]
+        # The reaper or an empty channel may have dropped it while stopping
+        self.voice_states.pop(ctx.guild.id, None)
         logger.info(f'Voice state cleaned up for guild {ctx.guild.name}')
         await ctx.send('OK bye')
 
@@ -582,7 +3646,12 @@ class Music(commands.Cog):
     @app_commands.describe(volume = 'Volume from 0 to 100')
     #@commands.has_permissions(manage_guild=True)
     async def _volume(self, ctx: commands.Context, volume: int = None):
-        """Sets the volume of the player."""
+        """Sets the volume of the player.
+
+        With OPUS_PASSTHROUGH songs are copied to Discord as they are only at
+        100%. At any other volume they are decoded and encoded again by FFmpeg,
+        and a change only applies from the next song.
+        """
         if not volume:
             return await ctx.send(ctx.voice_state.volume*100)
 
@@ -592,8 +3661,25 @@ class Music(commands.Cog):
         if 0 > volume > 100:
             return await ctx.send('Volume must be between 0 and 100')
 
-        ctx.voice_state._volume = volume / 100
-        await ctx.send('Volume of the player set to {}%'.format(volume))
+        ctx.voice_state.volume = volume / 100
+        if isinstance(ctx.voice_state.current.source, YTDLOpusSource):
+            await ctx.send('Volume of the player set to {}%, starting with the next song'.format(volume))
+        else:
+            await ctx.send('Volume of the player set to {}%'.format(volume))
+
+    @commands.hybrid_command(name='mode')
+    @app_commands.describe(mode = 'stream, download or progressive')
+    async def _mode(self, ctx: commands.Context, mode: str = None):
+        """Sets whether songs are streamed, downloaded before playing or played while downloading."""
+        if not mode:
+            return await ctx.send('Playback mode is {}'.format(ctx.voice_state.playback_mode))
+
+        mode = mode.lower()
+        if mode not in PLAYBACK_MODES:
+            return await ctx.send('Mode must be one of: {}'.format(', '.join(PLAYBACK_MODES)))
+
+        ctx.voice_state.playback_mode = mode
+        await ctx.send('Playback mode set to {}, starting with songs not loaded yet'.format(mode))
 
     @commands.hybrid_command(name='now', aliases=['current', 'playing'])
     async def _now(self, ctx: commands.Context):
@@ -603,6 +3689,25 @@ class Music(commands.Cog):
         else:
             await ctx.send(embed=ctx.voice_state.current.create_embed())
 
+    @commands.hybrid_command(name='seek')
+    @app_commands.describe(timestamp = 'Where to jump to, like 90, 1:30 or 1:01:30')
+    async def _seek(self, ctx: commands.Context, timestamp: str):
+        """Jumps to a position in the currently playing song."""
+        if not ctx.voice_state.is_playing or ctx.voice_state.current.source is None:
+            return await ctx.send('Nothing being played at the moment.')
+
+        try:
+            position = YTDLSource.parse_timestamp(timestamp)
+        except ValueError as e:
+            return await ctx.send(str(e))
+
+        seconds = ctx.voice_state.current.track.seconds
+        if seconds and position >= seconds:
+            return await ctx.send('The song is only {} long'.format(YTDLSource.format_timestamp(seconds)))
+
+        ctx.voice_state.seek(position)
+        await ctx.send('Seeking to {}'.format(YTDLSource.format_timestamp(position)))
+
     @commands.hybrid_command(name='sync')
     #@commands.has_permissions(manage_guild=True)
     async def _sync(self, ctx: commands.Context):
@@ -651,6 +3756,7 @@ class Music(commands.Cog):
     async def _stop(self, ctx: commands.Context):
         """Stops playing song and clears the queue."""
 
+        ctx.voice_state.cancel_playlist_loads()
         ctx.voice_state.songs.clear()
 
         if ctx.voice_state.is_playing:
@@ -710,12 +3816,12 @@ class Music(commands.Cog):
         queue = ''
         for i, song in enumerate(ctx.voice_state.songs[start:end],
                                  start=start):
-            queue += '`{0}.` [**{1.source.title}**]({1.source.url})\n'.format(
+            queue += '`{0}.` [**{1.track.title}**]({1.track.url}) `#{1.id}`\n'.format(
                 i + 1, song)
 
         embed = (discord.Embed(description='**{} tracks:**\n\n{}'.format(
             len(ctx.voice_state.songs), queue)).set_footer(
-                text='Viewing page {}/{}'.format(page, pages)))
+                text='Viewing page {}/{} ({} order)'.format(page, pages, ctx.voice_state.songs.mode)))
         await ctx.send(embed=embed)
 
     @commands.hybrid_command(name='shuffle')
@@ -737,9 +3843,66 @@ class Music(commands.Cog):
         if len(ctx.voice_state.songs) == 0:
             return await ctx.send('Empty queue.')
 
-        await ctx.send('Removing {0.source.title} at index:{1}'.format(ctx.voice_state.songs[index-1],index))
+        await ctx.send('Removing {0.track.title} at index:{1}'.format(ctx.voice_state.songs[index-1],index))
         ctx.voice_state.songs.remove(index - 1)
         #await ctx.message.add_reaction('✅')
+
+    @commands.hybrid_command(name='move')
+    @app_commands.describe(song_id = 'The #id shown in /queue', index = 'New position in the queue')
+    async def _move(self, ctx: commands.Context, song_id: int, index: int):
+        """Moves a song (by the #id shown in /queue) to a new position."""
+
+        if song_id not in ctx.voice_state.songs:
+            return await ctx.send('No song #{} in the queue.'.format(song_id))
+
+        songs = ctx.voice_state.songs
+        songs.move(song_id, index - 1)
+        position = next(i for i, song in enumerate(songs) if song.id == song_id) + 1
+        if position != index and songs.mode == 'fair':
+            return await ctx.send('Moved {0.track.title} to index:{1}, the closest spot in its requester\'s turns'.format(
+                songs.get_song(song_id), position))
+        await ctx.send('Moved {0.track.title} to index:{1}'.format(songs.get_song(song_id), position))
+
+    @commands.hybrid_command(name='removeuser')
+    @app_commands.describe(member = 'Whose songs to remove')
+    async def _remove_user(self, ctx: commands.Context, member: discord.Member):
+        """Removes every queued song requested by a member."""
+
+        removed = ctx.voice_state.songs.remove_requester(member.id)
+        await ctx.send('Removed {} songs requested by {}'.format(removed, member.display_name))
+
+    @commands.hybrid_command(name='queuemode')
+    @app_commands.describe(mode = 'fifo or fair')
+    async def _queue_mode(self, ctx: commands.Context, mode: str = None):
+        """Sets whether songs play in the order added (fifo) or take turns between requesters (fair)."""
+
+        if not mode:
+            return await ctx.send('Queue mode is {}'.format(ctx.voice_state.songs.mode))
+
+        mode = mode.lower()
+        if mode not in QUEUE_MODES:
+            return await ctx.send('Mode must be one of: {}'.format(', '.join(QUEUE_MODES)))
+
+        ctx.voice_state.songs.set_mode(mode)
+        await ctx.send('Queue mode set to {}'.format(mode))
+
+    @commands.hybrid_command(name='fairweight')
+    @app_commands.describe(member = 'Member to weight', weight = 'Songs per turn in fair mode')
+    async def _fair_weight(self, ctx: commands.Context, member: discord.Member, weight: int = 1):
+        """Sets how many songs a member gets per turn in fair mode."""
+
+        if weight < 1:
+            return await ctx.send('Weight must be at least 1')
+
+        ctx.voice_state.songs.set_weight(member.id, weight)
+        await ctx.send('{} now gets {} songs per turn'.format(member.display_name, weight))
+
+    @commands.hybrid_command(name='dedupe')
+    async def _dedupe(self, ctx: commands.Context):
+        """Removes songs that are already further up in the queue."""
+
+        removed = ctx.voice_state.songs.dedupe()
+        await ctx.send('Removed {} duplicate songs'.format(removed))
         
         
 
@@ -785,13 +3948,20 @@ class Music(commands.Cog):
                 await ctx.send(f'Failed to connect to voice channel. Try /fix then try again.')
                 return
 
+        if MAX_SONGS_PER_USER and ctx.voice_state.songs.count_for(ctx.author.id) >= MAX_SONGS_PER_USER:
+            return await ctx.send('You already have {} songs in the queue.'.format(MAX_SONGS_PER_USER))
+
+        if is_playlist_query(search):
+            async with ctx.typing():
+                return await self._play_playlist(ctx, search)
+
         async with ctx.typing():
             try:
-                logger.info(f'Creating YTDL source for: {search}')
-                source = await YTDLSource.create_source(ctx,
-                                                        search,
-                                                        loop=self.bot.loop)
-                logger.info(f'Successfully created source: {source.title}')
+                logger.info(f'Resolving YTDL track for: {search}')
+                track = await YTDLSource.resolve(ctx,
+                                                 search,
+                                                 loop=self.bot.loop)
+                logger.info(f'Successfully resolved track: {track.title}')
             except YTDLError as e:
                 logger.error(f'YTDL error for search "{search}": {e}')
                 await ctx.send(
@@ -803,10 +3973,83 @@ class Music(commands.Cog):
                 await ctx.send(f'Unexpected error: {e}')
                 return
                 
-            song = Song(source)
+            song = Song(track)
             await ctx.voice_state.songs.put(song)
-            logger.info(f'Enqueued song: {source.title} in guild {ctx.guild.name}')
-            await ctx.send('{} Enqueued {}'.format(ctx.author.mention,str(source)))
+            logger.info(f'Enqueued song: {track.title} in guild {ctx.guild.name}')
+            await ctx.send('{} Enqueued {}'.format(ctx.author.mention,str(track)))
+
+    async def _play_playlist(self, ctx: commands.Context, url: str):
+        """Enqueues the first song of a playlist right away and the rest in the background."""
+        logger.info(f'Loading playlist {url} in guild {ctx.guild.name}')
+        try:
+            first = await extraction_pool.submit(ctx.guild.id,
+                                                 _playlist_job,
+                                                 url, 1, 1,
+                                                 timeout=EXTRACT_TIMEOUT)
+        except Exception as e:
+            logger.error(f'Playlist lookup failed for "{url}": {e}')
+            return await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
+
+        if not first or not first['entries']:
+            return await ctx.send('Couldn\'t find anything in that playlist')
+
+        title = first['title'] or 'playlist'
+        total = min(first['count'] or PLAYLIST_MAX_ENTRIES, PLAYLIST_MAX_ENTRIES)
+
+        await ctx.voice_state.songs.put(Song(ResolvedTrack(ctx, first['entries'][0])))
+        message = await ctx.send('{} Enqueued 1/{} from **{}**'.format(ctx.author.mention, total, title))
+
+        if total > 1:
+            task = self.bot.loop.create_task(self._load_playlist(ctx, url, title, total, message))
+            ctx.voice_state.playlist_loads.add(task)
+            task.add_done_callback(ctx.voice_state.playlist_loads.discard)
+
+    async def _load_playlist(self, ctx: commands.Context, url: str, title: str, total: int, message: discord.Message):
+        enqueued = 1
+        start = 2
+        limited = False
+        while start <= total and not limited:
+            end = min(start + PLAYLIST_CHUNK - 1, total)
+            try:
+                chunk = await extraction_pool.submit(ctx.guild.id,
+                                                     _playlist_job,
+                                                     url, start, end,
+                                                     timeout=EXTRACT_TIMEOUT)
+            except Exception as e:
+                logger.error(f'Loading entries {start}-{end} of playlist "{url}" failed: {e}')
+                break
+
+            if not chunk:
+                break
+
+            for entry in chunk['entries']:
+                if MAX_SONGS_PER_USER and ctx.voice_state.songs.count_for(ctx.author.id) >= MAX_SONGS_PER_USER:
+                    limited = True
+                    break
+                await ctx.voice_state.songs.put(Song(ResolvedTrack(ctx, entry)))
+                enqueued += 1
+
+            try:
+                await message.edit(content='{} Enqueued {}/{} from **{}**'.format(
+                    ctx.author.mention, enqueued, total, title))
+            except discord.HTTPException as e:
+                logger.warning(f'Could not update playlist progress message: {e}')
+
+            if chunk['returned'] < end - start + 1:
+                # Reached the end of the playlist
+                break
+            start = end + 1
+
+        logger.info(f'Enqueued {enqueued} songs from playlist {url} in guild {ctx.guild.name}')
+        content = '{} Enqueued {} songs from **{}**'.format(ctx.author.mention, enqueued, title)
+        if limited:
+            content += ' (you can have at most {} songs queued)'.format(MAX_SONGS_PER_USER)
+        elif start > PLAYLIST_MAX_ENTRIES:
+            content += ' (playlists are capped at {} songs)'.format(PLAYLIST_MAX_ENTRIES)
+        try:
+            await message.edit(content=content)
+        except discord.HTTPException:
+            pass
 
     @commands.hybrid_command(name='player',aliases=['gui','buttons'])
     
@@ -824,12 +4067,11 @@ class Music(commands.Cog):
             # Clear the song queue
             if ctx.guild.id in self.voice_states:
                 voice_state = self.voice_states[ctx.guild.id]
-                voice_state.songs.clear()
-
-                # Cancel the audio player task
-                if voice_state.audio_player and not voice_state.audio_player.done():
-                    voice_state.audio_player.cancel()
-                    logger.info(f'Cancelled audio player task for guild {ctx.guild.name}')
+                # Cancels its tasks and releases the songs it holds, the voice
+                # client gets force disconnected below instead
+                voice_state.voice = None
+                await voice_state.stop()
+                logger.info(f'Stopped voice state for guild {ctx.guild.name}')
 
             # Force disconnect any existing voice client
             existing_client = ctx.guild.voice_client
@@ -841,8 +4083,8 @@ class Music(commands.Cog):
                     logger.warning(f'Error force disconnecting: {e}')
 
             # Clean up voice state
-            if ctx.guild.id in self.voice_states:
-                del self.voice_states[ctx.guild.id]
+            if self.voice_states.pop(ctx.guild.id, None) is not None:
+                state_journal.record(ctx.guild.id, 'voice', value=None)
                 logger.info(f'Deleted voice state for guild {ctx.guild.name}')
 
             await ctx.send('Fixed! Use /come or /play to reconnect.')
@@ -850,15 +4092,15 @@ class Music(commands.Cog):
         except Exception as e:
             logger.error(f'Error in fix command: {e}')
             # Still try to clean up
-            if ctx.guild.id in self.voice_states:
-                del self.voice_states[ctx.guild.id]
+            self.voice_states.pop(ctx.guild.id, None)
             await ctx.send('Fixed (with errors). Use /come or /play to reconnect.')
     
     @commands.hybrid_command(name='servercount')
     #@commands.has_permissions(manage_guild=True)
     async def servercount(self, ctx: commands.Context):
         """Tells how many servers the bot is in"""      
-        await ctx.send('I am serving {} humans and {} bots across {} servers'.format(sum(not m.bot for m in bot.get_all_members()),sum(m.bot for m in bot.get_all_members()),len(self.bot.guilds)))
+        # member_count comes with the guild, members don't have to be cached
+        await ctx.send('I am serving {} members across {} servers'.format(sum(guild.member_count or 0 for guild in self.bot.guilds),len(self.bot.guilds)))
 
     
     # @commands.hybrid_command(name='log')
@@ -880,6 +4122,117 @@ class Music(commands.Cog):
         """check if opus is loaded"""
         await ctx.send(discord.opus.is_loaded())
 
+    @commands.hybrid_command(name='cachestats')
+    @commands.is_owner()
+    async def cache_stats(self, ctx: commands.Context):
+        """shows download and metadata cache usage"""
+        stats = download_cache.stats()
+        await ctx.send('cache: {files} files, {bytes}/{max_bytes} bytes, {pinned} pinned, '
+                       '{hits} hits, {misses} misses ({hit_rate:.0%}), {evictions} evictions'.format(**stats))
+        stats = await self.bot.loop.run_in_executor(None, metadata_cache.stats)
+        await ctx.send('metadata: {queries} queries, {infos} tracks, '
+                       '{hits} hits, {misses} misses ({hit_rate:.0%})'.format(**stats))
+
+    @commands.hybrid_command(name='extractstats')
+    @commands.is_owner()
+    async def extract_stats(self, ctx: commands.Context):
+        """shows extraction worker pool usage"""
+        await ctx.send('extraction: {mode} x{workers} + {download_workers} for downloads, generation {generation} (yt-dlp {version}), {draining} draining, '
+                       '{active} active, {downloading} downloading, {queued} queued from {guilds_waiting} guilds, '
+                       '{completed} done, {failed} failed, {timeouts} timed out, {rejected} rejected'.format(**extraction_pool.stats()))
+
+    @commands.hybrid_command(name='downloadstats')
+    @commands.is_owner()
+    async def download_stats(self, ctx: commands.Context):
+        """shows download slots, waiting downloads and throughput"""
+        lines = ['downloads: {active}/{concurrency} running, {waiting} waiting, {completed} done, '
+                 '{throughput:.2f} MB/s average, bandwidth {bandwidth}'.format(**download_scheduler.stats())]
+        for title, size, seconds in download_scheduler.recent:
+            lines.append('{}: {:.1f} MB in {:.1f}s ({:.2f} MB/s)'.format(
+                title, size / 1048576, seconds, size / 1048576 / max(seconds, 0.001)))
+        await ctx.send('\n'.join(lines)[:2000])
+
+    @commands.hybrid_command(name='clientstats')
+    @commands.is_owner()
+    async def client_stats(self, ctx: commands.Context):
+        """shows youtube player clients in the order they are tried, with recent results"""
+        lines = []
+        for row in player_clients.stats():
+            line = '{client}: {tries} recent tries'.format(**row)
+            if row['success'] is not None:
+                line += ', {:.0%} ok'.format(row['success'])
+            if row['latency'] is not None:
+                line += ', {:.2f}s avg'.format(row['latency'])
+            if row['skipped_for']:
+                line += ', skipped for another {:.0f}s'.format(row['skipped_for'])
+            line += ', skipped {} times'.format(row['skips'])
+            lines.append(line)
+        await ctx.send('\n'.join(lines) or 'No player clients configured')
+
+    @commands.hybrid_command(name='reloadextractor')
+    @commands.is_owner()
+    @app_commands.describe(update = 'Update yt-dlp with pip first')
+    async def reload_extractor(self, ctx: commands.Context, update: bool = False):
+        """swaps in fresh yt-dlp workers without restarting or leaving voice"""
+        await ctx.send('Updating and reloading extractor' if update else 'Reloading extractor')
+        if update and not await update_yt_dlp():
+            return await ctx.send('yt-dlp update failed, see the log. Nothing was reloaded.')
+
+        started = time.perf_counter()
+        try:
+            version = await extraction_pool.reload()
+        except Exception as e:
+            return await ctx.send('Reload failed, still on generation {}: {}'.format(extraction_pool.generation, e))
+        await ctx.send('Extractor generation {} running yt-dlp {}, ready in {:.1f}s'.format(
+            extraction_pool.generation, version, time.perf_counter() - started))
+        if extraction_pool.held_back:
+            await ctx.send('The newer yt-dlp in {} is NOT loaded: thread workers keep the version the bot started '
+                           'with. Restart the bot to use it, or run with EXTRACT_MODE=process to reload without '
+                           'restarting.'.format(extraction_pool.held_back))
+
+    @commands.hybrid_command(name='flightstats')
+    @commands.is_owner()
+    async def flight_stats(self, ctx: commands.Context):
+        """shows how many lookups and downloads were shared"""
+        for flights in (resolve_flights, download_flights):
+            await ctx.send('{0.name}: {0.started} started, {0.shared} shared, {0.abandoned} abandoned, {1} in flight'.format(
+                flights, len(flights.calls)))
+
+    @commands.hybrid_command(name='trackmemory')
+    @commands.is_owner()
+    async def track_memory(self, ctx: commands.Context):
+        """compares memory per queued song with the full info dicts"""
+        tracks = [song.track for state in self.voice_states.values() for song in state.songs]
+        if tracks:
+            compact = sum(track.memory_size() for track in tracks) / len(tracks)
+            await ctx.send('{} queued songs, compact record: {:.0f} bytes per song'.format(len(tracks), compact))
+        else:
+            await ctx.send('No queued songs to measure')
+
+        if info_dict_sizes:
+            full = sum(info_dict_sizes) / len(info_dict_sizes)
+            await ctx.send('full info dict: {:.0f} bytes per song (last {} lookups)'.format(full, len(info_dict_sizes)))
+        else:
+            await ctx.send('No info dicts measured, set TRACK_MEMORY_SAMPLE to sample lookups')
+
+    @commands.hybrid_command(name='voicestats')
+    @commands.is_owner()
+    async def voice_stats(self, ctx: commands.Context):
+        """shows automatic voice reconnects per guild"""
+        lines = ['{}: {} reconnects, last took {:.2f}s, slowest {:.2f}s'.format(
+                     state.guild.name, len(state.reconnects), state.reconnects[-1], max(state.reconnects))
+                 for state in self.voice_states.values() if state.reconnects]
+        lines.append('{} voice states, {} reaped for being idle'.format(len(self.voice_states), self.reaped))
+        await ctx.send('\n'.join(lines))
+
+    @commands.hybrid_command(name='voicelogstats')
+    @commands.is_owner()
+    async def voice_log_stats(self, ctx: commands.Context):
+        """shows how many voice log lines were posted, batched and dropped"""
+        await ctx.send('Voice log: {pending} pending, {sent_lines} lines in {sent_messages} messages, '
+                       '{dropped_full} dropped (backlog full), {dropped_no_channel} dropped (no logs channel), '
+                       '{dropped_failed} dropped ({failed} failed sends)'.format(**voice_log.stats()))
+
     @commands.hybrid_command(name='loadopus')
     @commands.is_owner()
     async def loadopus(self, ctx: commands.Context):
@@ -907,12 +4260,23 @@ class Music(commands.Cog):
     async def list_members(self, ctx: commands.Context, serverid: int):
         """lists members of server id"""
         
-        for server in self.bot.guilds:
-            if server.id == serverid:
-                #await ctx.send('server name: {}, server id: {}, owner: {}, owner id: {},member count: {}'.format(server.name, server.id, server.owner,server.owner_id,server.member_count,))
-                for member in server.members:
-                    await ctx.send('member name:{}, memberid:{}'.format(member.name,member.id))
-                break
+        server = self.bot.get_guild(serverid)
+        if server is None:
+            return await ctx.send('Not in a server with id {}'.format(serverid))
+
+        # Listing members needs the members intent, without it only the count can be fetched
+        if not self.bot.intents.members:
+            counted = await self.bot.fetch_guild(serverid, with_counts=True)
+            count = counted.approximate_member_count or server.member_count
+            return await ctx.send('{} has about {} members, listing them needs INTENTS_PROFILE=full'.format(
+                server.name, count))
+
+        # Members aren't cached up front, get them only when asked for
+        members = server.members if server.chunked else await server.chunk()
+
+        #await ctx.send('server name: {}, server id: {}, owner: {}, owner id: {},member count: {}'.format(server.name, server.id, server.owner,server.owner_id,server.member_count,))
+        for member in members:
+            await ctx.send('member name:{}, memberid:{}'.format(member.name,member.id))
 
     @commands.hybrid_command(name='forcerestart')
     #@commands.is_owner()
@@ -990,7 +4354,6 @@ class Music(commands.Cog):
     
 
 
-@bot.tree.context_menu(name='Show Join Date')
 async def show_join_date(interaction: discord.Interaction, member: discord.Member):
     # The format_dt function formats the date time into a human readable representation in the official client
     await interaction.response.send_message(f'{member} joined at {discord.utils.format_dt(member.joined_at)}')
@@ -1008,26 +4371,40 @@ async def show_join_date(interaction: discord.Interaction, member: discord.Membe
 
 
 
-@bot.event
 async def on_voice_state_update(member,before,after):
     #print("{member},Joined")
-    logchannel = discord.utils.get(member.guild.text_channels, name="logs")
     if not before.channel and after.channel:
-        await logchannel.send(f"""{member.mention}Joined {after.channel}""")
+        voice_log.add(member.guild, f"""{member.mention}Joined {after.channel}""")
     
     elif not after.channel and before.channel:
-        await logchannel.send(f"""{member.mention}Left {before.channel}""")
+        voice_log.add(member.guild, f"""{member.mention}Left {before.channel}""")
 
     elif after.channel and before.channel and (after.channel != before.channel):
-        await logchannel.send(f"""{member.mention}Left {before.channel} and joined {after.channel}""")
+        voice_log.add(member.guild, f"""{member.mention}Left {before.channel} and joined {after.channel}""")
+
+
+async def on_guild_channel_create(channel):
+    voice_log.invalidate(channel.guild.id)
+
+
+async def on_guild_channel_delete(channel):
+    voice_log.invalidate(channel.guild.id)
+
+
+async def on_guild_channel_update(before, after):
+    if before.name != after.name:
+        voice_log.invalidate(after.guild.id)
 
 
 
-@bot.event
 async def on_ready():
     print('Logged in as:\nBOT:{0.user.name}\nUSER:{0.user.id}'.format(bot))
     print(f"Discord API version: {discord.__version__}")
     print('Command Prefix:',os.environ['COMMAND_PREFIX'])
+    voice_log.start()
+    if not hasattr(bot, 'ready_after'):
+        bot.ready_after = time.perf_counter() - STARTED_AT
+        logger.info(f'Ready {bot.ready_after:.2f} seconds after process start')
 
     # Log YouTube client configuration
     extractor_args = YTDLSource.YTDL_OPTIONS.get('extractor_args', {})
@@ -1069,13 +4446,31 @@ async def on_ready():
     #print(await bot.tree.fetch_commands())
 
 
+async def update_and_reload():
+    """Updates yt-dlp and, if that worked, switches the extractor over to it."""
+    if await update_yt_dlp():
+        try:
+            await extraction_pool.reload()
+        except Exception as e:
+            logger.error(f'Reloading the extractor after the yt-dlp update failed: {e}')
+
+
 async def main():
-    update_yt_dlp()
+    if YTDLP_UPDATE == 'blocking':
+        await update_yt_dlp()
+    await extraction_pool.start()
     async with bot:
         
         await bot.add_cog(Music(bot))
+        if YTDLP_UPDATE == 'background':
+            # Kept referenced so the task isn't garbage collected while pip runs
+            bot.yt_dlp_update = asyncio.create_task(update_and_reload())
         await bot.start(os.environ['TOKEN'])
         
 
 
-asyncio.run(main())
+if __name__ == '__main__':
+    download_cache.load()
+    metadata_cache.open()
+    bot = create_bot()
+    asyncio.run(main())